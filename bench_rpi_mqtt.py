@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Benchmark the MQTT bridge without a keyboard or broker.
+
+Synthetic workloads are published through an in-process broker stand-in
+straight into rpi_mqtt.on_message, once per LED backend. For each run we
+report messages/sec, p50/p99 latency per message and CPU time per message,
+and can save the results as JSON to compare against another version:
+
+    python3 bench_rpi_mqtt.py --output before.json
+    ... change things ...
+    python3 bench_rpi_mqtt.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+import rpi_mqtt
+from rpi_mqtt import BASE, FRAME_SIZE
+
+class MockKeyboard:
+    """Stands in for RPiKeyboardConfig behind the library backend (no output)."""
+
+    def __init__(self):
+        self.model = "PI500PLUS"
+        self.variant = "ISO"
+        self.calls = 0
+
+    def set_led_direct_effect(self):
+        self.calls += 1
+
+    def rgb_clear(self):
+        self.calls += 1
+
+    def set_led_by_idx(self, idx, colour):
+        self.calls += 1
+
+    def set_led_by_matrix(self, matrix, colour):
+        self.calls += 1
+
+    def send_leds(self):
+        self.calls += 1
+
+class Message:
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+class LoopbackBroker:
+    """Delivers publishes to on_message for matching subscriptions, in-process."""
+
+    def __init__(self, on_message, subscriptions):
+        self.on_message = on_message
+        self.subscriptions = [s.split("/") for s in subscriptions]
+
+    def matches(self, topic: str) -> bool:
+        parts = topic.split("/")
+        for filt in self.subscriptions:
+            if len(filt) == len(parts) or (filt and filt[-1] == "#"):
+                if all(f in ("+", "#") or f == p for f, p in zip(filt, parts)):
+                    return True
+        return False
+
+    def publish(self, topic: str, payload: bytes):
+        if self.matches(topic):
+            self.on_message(self, None, Message(topic, payload))
+
+# ----- Workloads -----
+# Each returns a list of (topic, payload) to publish.
+
+COLOURS = ["red", "green", "blue", "#FF8000", "rgb(10,200,30)",
+           '{"r":255,"g":0,"b":128}', '{"h":40,"s":255,"v":200}', "170,255,255"]
+
+def solid_flood(n: int, rng: random.Random):
+    return [(f"{BASE}/led", rng.choice(COLOURS).encode()) for _ in range(n)]
+
+def per_key_storm(n: int, rng: random.Random):
+    return [(f"{BASE}/led/{rng.randrange(6)},{rng.randrange(15)}", rng.choice(COLOURS).encode())
+            for _ in range(n)]
+
+def full_frames(n: int, rng: random.Random):
+    return [(f"{BASE}/frame", rng.randbytes(FRAME_SIZE)) for _ in range(n)]
+
+def batches(n: int, rng: random.Random):
+    def batch():
+        return json.dumps([{"rc": f"{rng.randrange(6)},{rng.randrange(15)}", "colour": rng.choice(COLOURS)}
+                           for _ in range(10)]).encode()
+    return [(f"{BASE}/led/batch", batch()) for _ in range(n)]
+
+WORKLOADS = {
+    "solid_flood": solid_flood,
+    "per_key_storm": per_key_storm,
+    "full_frames": full_frames,
+    "batches": batches,
+}
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def _reset(backend_name: str):
+    rpi_mqtt.effects.stop()
+    rpi_mqtt.set_brightness(255)
+    rpi_mqtt.set_hue(0)
+    if backend_name == "library":
+        rpi_mqtt.device.handle = None
+        rpi_mqtt.device.factory = MockKeyboard
+        rpi_mqtt.use_backend("library")
+    elif backend_name == "cli":
+        rpi_mqtt.use_backend("cli")
+        # `true` costs a process spawn per call, like the real tool
+        rpi_mqtt.backend.command = shutil.which("true")
+    else:
+        rpi_mqtt.use_backend(backend_name)
+    rpi_mqtt.flush()
+
+def run_messages(backend_name: str, workload: str, n: int, seed: int) -> dict:
+    _reset(backend_name)
+    messages = WORKLOADS[workload](n, random.Random(seed))
+    broker = LoopbackBroker(rpi_mqtt.on_message, rpi_mqtt.router.subscriptions())
+    latencies = []
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    for topic, payload in messages:
+        start = time.perf_counter()
+        broker.publish(topic, payload)
+        latencies.append(time.perf_counter() - start)
+    return _result(backend_name, workload, latencies, time.perf_counter() - wall,
+                   time.process_time() - cpu)
+
+def run_effect(backend_name: str, effect: str, n: int) -> dict:
+    """Render and write n effect frames (as the render loop would)."""
+    _reset(backend_name)
+    rpi_mqtt.effects.start(effect)
+    latencies = []
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    for i in range(n):
+        start = time.perf_counter()
+        rpi_mqtt.effects._next_frame = 0.0  # ignore the frame pacing, render every step
+        rpi_mqtt.effects.step(rpi_mqtt.effects._started + i / rpi_mqtt.MAX_FPS)
+        rpi_mqtt.flush()
+        latencies.append(time.perf_counter() - start)
+    rpi_mqtt.effects.stop()
+    return _result(backend_name, f"effect_{effect}", latencies, time.perf_counter() - wall,
+                   time.process_time() - cpu)
+
+def _result(backend_name, workload, latencies, wall, cpu) -> dict:
+    latencies.sort()
+    n = len(latencies)
+    return {
+        "backend": backend_name,
+        "workload": workload,
+        "messages": n,
+        "msgs_per_sec": round(n / wall, 1) if wall else 0,
+        "p50_us": round(_percentile(latencies, 0.5) * 1e6, 1),
+        "p99_us": round(_percentile(latencies, 0.99) * 1e6, 1),
+        "cpu_us_per_msg": round(cpu / n * 1e6, 1) if n else 0,
+    }
+
+def _git_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True,
+                              text=True, timeout=5).stdout.strip() or "unknown"
+    except Exception:
+        return "unknown"
+
+def print_results(results, baseline=None):
+    base = {(r["backend"], r["workload"]): r for r in (baseline or [])}
+    header = f"{'backend':8} {'workload':20} {'msgs':>6} {'msgs/s':>10} {'p50 us':>9} {'p99 us':>9} {'cpu us/msg':>10}"
+    if baseline:
+        header += f" {'vs baseline':>12}"
+    print(header)
+    for r in results:
+        line = (f"{r['backend']:8} {r['workload']:20} {r['messages']:6} {r['msgs_per_sec']:10.1f} "
+                f"{r['p50_us']:9.1f} {r['p99_us']:9.1f} {r['cpu_us_per_msg']:10.1f}")
+        old = base.get((r["backend"], r["workload"]))
+        if old and old["msgs_per_sec"]:
+            line += f" {r['msgs_per_sec'] / old['msgs_per_sec']:11.2f}x"
+        print(line)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default="mock,library,cli",
+                        help="comma-separated backends to run (default: %(default)s)")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma-separated workloads (default: %(default)s)")
+    parser.add_argument("--effects", default="wave,breathe",
+                        help="comma-separated effects to render ('' for none)")
+    parser.add_argument("-n", "--messages", type=int, default=2000, help="messages per workload")
+    parser.add_argument("--cli-messages", type=int, default=50,
+                        help="messages per workload for the (slow) cli backend")
+    parser.add_argument("--seed", type=int, default=500)
+    parser.add_argument("--output", help="save results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results from an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    results = []
+    for backend_name in filter(None, args.backends.split(",")):
+        if backend_name == "cli" and not shutil.which("true"):
+            print("Skipping cli backend: no `true` command to stand in for rpi-keyboard-config")
+            continue
+        n = args.cli_messages if backend_name == "cli" else args.messages
+        for workload in filter(None, args.workloads.split(",")):
+            results.append(run_messages(backend_name, workload, n, args.seed))
+        for effect in filter(None, args.effects.split(",")):
+            results.append(run_effect(backend_name, effect, n))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        report = {
+            "version": _git_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,398 +1,2382 @@
 #!/usr/bin/env python3
+import asyncio
+import base64
+import bisect
+import functools
+import heapq
+import itertools
 import json
+import logging
+import logging.handlers
+import math
+import mmap
 import os
+import queue
 import re
+import signal
+import socket
+import struct
 import subprocess
+import threading
 import time
-from typing import Tuple, Optional
-
-import paho.mqtt.client as mqtt
-from RPiKeyboardConfig import RPiKeyboardConfig
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Tuple, Optional, Union
 
 # --- CONFIG ---
 MQTT_HOST = "192.168.1.152"
 MQTT_PORT = 1883
 BASE = "home/keyboard"  # topic root
+LED_BACKEND = "library"  # "library" (in-process, fast), "cli" (rpi-keyboard-config subprocess) or "mock" (no hardware)
+LED_COUNT = 85
+MAX_FPS = 30  # upper bound on keyboard updates per second
+FRAME_SIZE = LED_COUNT * 3  # packed RGB bytes in a {BASE}/frame payload
+EFFECT_CPU_BUDGET = 0.03  # share of one CPU core software effects may use
+RECONNECT_MIN_DELAY = 0.5  # seconds before the first keyboard reopen attempt
+RECONNECT_MAX_DELAY = 30   # backoff doubles up to this
+LOG_LEVEL = "INFO"  # "DEBUG" logs every message received
+LOG_BURST = 20      # identical log lines allowed per LOG_INTERVAL before sampling
+LOG_INTERVAL = 10   # seconds
+LOG_PAYLOAD_CHARS = 200  # longest text payload quoted in an error line
+STATS_INTERVAL = 30  # seconds between {BASE}/stats publishes (0 = off)
+METRICS_PORT: Optional[int] = None  # e.g. 9105 to serve Prometheus metrics over HTTP
+PRESET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "presets.bin")
+KEYMAP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "keymap.json")  # discovered layout cache
+CLIP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clips")  # large clips, mmapped
+CLIP_MMAP_BYTES = 1 << 20   # clips at least this big are kept in CLIP_DIR instead of memory
+CLIP_MAX_BYTES = 64 << 20   # largest clip accepted (after decompression)
+MAX_LAYERS = 16  # named layers allowed over the base frame
+NOTIFY_TTL = 10       # seconds a notification shows unless it says otherwise
+NOTIFY_LIMIT = 1000   # notifications pending at once
+MAX_TRANSITION = 60  # longest fade in seconds a payload may ask for
+SYSMON_INTERVAL = 0.5  # seconds between /proc reads for the system-metrics effects
+SYSMON_NET_SCALE: Optional[float] = None  # bytes/sec shown as a full network bar (None = scale to the recent peak)
+STREAM_UDP_PORT: Optional[int] = None  # e.g. 21324 to accept frames over UDP
+STREAM_SOCKET: Optional[str] = None    # e.g. "/run/rpi_mqtt.sock" for a Unix datagram socket
+STREAM_TIMEOUT = 1.0  # seconds of silence after which a sender may restart its sequence
+RUNTIME = "thread"  # "thread" (paho loop_forever + render thread) or "asyncio"
+INBOX_LIMIT = 1024  # pending messages kept once coalescing can't shrink the backlog
 # ----------------
 
-# ----- Keyboard instance -----
-keyboard = RPiKeyboardConfig()
+# ----- Logging -----
+# Log calls use lazy %-formatting and go through a queue: the MQTT and render
+# threads only enqueue records, a listener thread formats and writes them.
 
-def set_effect(effect: str, *, speed: Optional[int] = None,
-               hue: Optional[int] = None, saturation: Optional[int] = None):
-    # Note: Effects may need to be implemented differently with the library
-    # For now, we'll set direct LED control mode and handle basic effects
-    keyboard.set_led_direct_effect()
-    if effect.lower() == "clear" or effect.lower() == "off":
-        keyboard.rgb_clear()
-    # Other effects would need custom implementation
+log = logging.getLogger("rpi_mqtt")
 
-def set_preset_index(index: int):
-    # Presets are not directly available in the library API
-    # This would need custom implementation based on specific presets
-    pass
+class RateLimitFilter(logging.Filter):
+    """Let each log call through at most `burst` times per `interval` seconds.
 
-def list_effects() -> str:
-    # Effects list is not available via library, return basic options
-    return "clear, solid"
+    Records are keyed by their unformatted message, so a flood of messages
+    from one call (e.g. one per MQTT message) is cut down to a sample while
+    other log lines are unaffected. The first record after a window with
+    drops says how many were suppressed.
+    """
 
-def set_brightness(val: int):
-    # Brightness control may need to be implemented by adjusting LED values
-    # The library doesn't have a direct brightness method
-    # This is a placeholder - you may need to store brightness and apply it to colors
-    pass
+    def __init__(self, burst: int = LOG_BURST, interval: float = LOG_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows: dict[tuple, list] = {}  # key → [window start, records seen]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.levelno, record.msg)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or record.created - window[0] >= self.interval:
+                suppressed = window[1] - self.burst if window is not None else 0
+                self._windows[key] = [record.created, 1]
+                if suppressed > 0:
+                    record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+                return True
+            window[1] += 1
+            return window[1] <= self.burst
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Same-process queue: leave formatting to the listener thread
+        return record
+
+def setup_logging(level: str = LOG_LEVEL) -> logging.handlers.QueueListener:
+    """Log to stderr from a background thread; returns the (started) listener."""
+    records = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(records)
+    handler.addFilter(RateLimitFilter())
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(records, output)
+    log.addHandler(handler)
+    log.setLevel(level)
+    log.propagate = False
+    listener.start()
+    return listener
+
+# ----- Metrics -----
+# Counters and latency histograms for the message path, published as JSON
+# to {BASE}/stats and optionally served in Prometheus text format.
+
+# Histogram bucket upper bounds, in seconds
+METRIC_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                  0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (max for the last bucket)."""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(METRIC_BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+def _metric_key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+def _metric_name(key: tuple, quote: bool = True) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    if quote:
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+    return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.counters: dict[tuple, int] = {}
+        self.histograms: dict[tuple, Histogram] = {}
+        # name → function returning the current value (e.g. a queue length)
+        self.gauges: dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: int = 1, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        self.gauges[name] = read
+
+    def snapshot(self) -> dict:
+        """Current values, JSON-ready. Latencies are in milliseconds."""
+        with self._lock:
+            counters = {_metric_name(k, quote=False): v for k, v in self.counters.items()}
+            histograms = {
+                _metric_name(k, quote=False): {
+                    "count": h.count,
+                    "mean_ms": round(h.sum / h.count * 1000, 3) if h.count else 0,
+                    "p50_ms": round(h.quantile(0.5) * 1000, 3),
+                    "p99_ms": round(h.quantile(0.99) * 1000, 3),
+                    "max_ms": round(h.max * 1000, 3),
+                }
+                for k, h in self.histograms.items()
+            }
+        return {
+            "uptime": round(time.time() - self.started),
+            "counters": counters,
+            "latency": histograms,
+            "gauges": {name: read() for name, read in self.gauges.items()},
+        }
+
+    def prometheus(self, prefix: str = "rpi_mqtt_") -> str:
+        """Current values in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for key, value in sorted(self.counters.items()):
+                lines.append(f"{prefix}{_metric_name(key)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(METRIC_BUCKETS + (float("inf"),), h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{prefix}{_metric_name((name + '_bucket', labels + (('le', le),)))} {cumulative}")
+                lines.append(f"{prefix}{_metric_name((name + '_sum', labels))} {h.sum}")
+                lines.append(f"{prefix}{_metric_name((name + '_count', labels))} {h.count}")
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"{prefix}{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class StatsPublisher:
+    """Publish metrics.snapshot() to {BASE}/stats every `interval` seconds.
+
+    Runs as an animator on the render loop, which is already awake on a timer.
+    """
 
-def set_hue(val: int):
-    # Hue control would need to be implemented by setting all LEDs to the hue
-    # This is a placeholder for custom implementation
-    pass
+    def __init__(self, client, interval: float = STATS_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self._next = time.monotonic() + interval
+
+    def next_due(self, now: float) -> Optional[float]:
+        return max(0.0, self._next - now)
+
+    def step(self, now: float) -> bool:
+        if now < self._next:
+            return False
+        self._next = now + self.interval
+        self.client.publish(f"{BASE}/stats", json.dumps(metrics.snapshot()))
+        return True
+
+def serve_metrics(port: int):
+    """Serve Prometheus metrics on http://<host>:<port>/metrics from a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
-def leds_clear():
-    print(f"[DEBUG] Clearing all LEDs using CLI")
-    try:
-        result = subprocess.run(['rpi-keyboard-config', 'leds', 'clear'],
-                              capture_output=True, text=True, timeout=5)
-        if result.returncode == 0:
-            print(f"[DEBUG] LED clear complete via CLI")
-        else:
-            print(f"[DEBUG] CLI clear failed: {result.stderr}")
-    except Exception as e:
-        print(f"[DEBUG] LED clear failed: {e}")
-        raise
+        def log_message(self, format, *args):
+            log.debug("metrics: " + format, *args)
 
-def leds_set_all_OLD(colour: str):
-    # Convert colour string to RGB tuple and set all LEDs
-    rgb = _parse_colour_to_rgb(colour)
-    print(f"[DEBUG] Setting all LEDs to RGB: {rgb}")
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
 
-    try:
-        # Try with fresh keyboard instance
-        print(f"[DEBUG] Creating fresh keyboard instance")
-       
-        print(f"[DEBUG] Current working directory: {os.getcwd()}")
-        print(f"[DEBUG] Current user ID: {os.getuid()}")
-        print(f"[DEBUG] Environment PATH: {os.environ.get('PATH', 'NOT SET')}")
+# ----- Keyboard instance -----
+# Nothing touches the keyboard at import time: the handle is opened by
+# main() or by the first LED write, so this module imports (and its parsing
+# and dispatch can be tested) on machines without the keyboard or library.
 
-        fresh_keyboard = RPiKeyboardConfig()
-        print(f"[DEBUG] Keyboard instance created successfully")
-        print(f"[DEBUG] Keyboard model: {fresh_keyboard.model}")
-        print(f"[DEBUG] Keyboard variant: {fresh_keyboard.variant}")
+def _open_keyboard():
+    from RPiKeyboardConfig import RPiKeyboardConfig
+    return RPiKeyboardConfig()
 
-        # Set direct LED control mode first
-        print(f"[DEBUG] Setting LED direct effect mode")
-        fresh_keyboard.set_led_direct_effect()
+class DeviceUnavailable(RuntimeError):
+    """The keyboard is disconnected and the next reopen attempt isn't due yet."""
 
-        # Let's try the EXACT same approach that worked in direct tests
-        print(f"[DEBUG] Using exact same approach as working direct test")
-        print(f"[DEBUG] Clearing first...")
-        fresh_keyboard.rgb_clear()
+class DeviceManager:
+    """Owns the single long-lived RPiKeyboardConfig handle.
 
-    
-        time.sleep(0.5)
+    Callers get the handle from open(). When an operation on it fails they
+    call lost(), which drops the handle; the next open() reopens it, backing
+    off exponentially between failed attempts. open() never sleeps - while
+    backing off it raises DeviceUnavailable straight away. After a reopen the
+    on_reconnect callbacks run (used to replay the framebuffer).
+    """
 
-        print(f"[DEBUG] Setting LED direct effect")
-        fresh_keyboard.set_led_direct_effect()
+    def __init__(self, factory: Callable = _open_keyboard,
+                 min_delay: float = RECONNECT_MIN_DELAY, max_delay: float = RECONNECT_MAX_DELAY):
+        self.factory = factory
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.handle = None
+        self.failures = 0
+        self.reconnects = 0
+        self.on_reconnect: list[Callable[[], None]] = []
+        self._retry_at = 0.0
+        self._opened = False
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self.handle is not None
+
+    def open(self):
+        with self._lock:
+            if self.handle is not None:
+                return self.handle
+            now = time.monotonic()
+            if now < self._retry_at:
+                raise DeviceUnavailable(f"Keyboard unavailable, retrying in {self._retry_at - now:.1f}s")
+            try:
+                self.handle = self.factory()
+            except Exception as e:
+                self._backoff(now)
+                log.warning("Opening keyboard failed (%d in a row): %s", self.failures, e)
+                raise
+            handle = self.handle
+            reopened = self._opened
+            self._opened = True
+            self.failures = 0
+        if reopened:
+            self.reconnects += 1
+            log.info("Keyboard reconnected")
+            for callback in self.on_reconnect:
+                callback()
+        return handle
+
+    def lost(self, error: Exception):
+        with self._lock:
+            if self.handle is None:
+                return
+            self.handle = None
+            self._backoff(time.monotonic())
+        log.warning("Keyboard connection lost: %s", error)
+
+    def _backoff(self, now: float):
+        self.failures += 1
+        delay = min(self.max_delay, self.min_delay * 2 ** (self.failures - 1))
+        self._retry_at = now + delay
+
+    # Animator interface: wake the render loop when a reopen is due, so
+    # pending changes are retried without waiting for the next message
+    def next_due(self, now: float) -> Optional[float]:
+        if self.handle is not None or self.failures == 0:
+            return None  # open, or not tried yet
+        return max(0.0, self._retry_at - now)
+
+    def step(self, now: float) -> bool:
+        # Retry even with nothing pending, so the backoff (and next_due) moves on
+        if self.handle is not None or self.failures == 0 or now < self._retry_at:
+            return False
+        try:
+            self.open()
+        except Exception:
+            return False
+        return True  # the render loop flushes whatever waited for the keyboard
 
-        print(f"[DEBUG] Trying the EXACT sequence that worked in direct test")
+device = DeviceManager()
 
-        # Replicate the exact working test sequence
-        print(f"[DEBUG] Step 1: Clear LEDs")
-        fresh_keyboard.rgb_clear()
+def set_effect(effect: str, *, speed: Optional[int] = None,
+               hue: Optional[int] = None, saturation: Optional[int] = None):
+    # Effects are rendered in software (see EFFECTS) and animated by the
+    # render loop; the keyboard itself stays in Direct mode
+    name = effect.strip().lower()
+    if name == "clear" or name == "off":
+        leds_clear()
+        return
+    if name not in EFFECTS:
+        raise ValueError(f"Unknown effect '{effect}' (choose from: {list_effects()})")
+    fades.cancel()
+    player.stop()
+    effects.start(name, speed=speed, hue=hue, saturation=saturation)
+    # Draw the first frame now; the render loop takes it from there
+    effects.step(time.monotonic())
+    request_flush()
 
-    
-        time.sleep(0.5)
+def set_preset_index(index: int):
+    # Presets are stored by the bridge (see PresetStore); the keyboard's
+    # own presets are not reachable through the library API
+    presets.recall(index)
 
-        print(f"[DEBUG] Step 2: Set direct effect")
-        fresh_keyboard.set_led_direct_effect()
+def list_effects() -> str:
+    return ", ".join(["clear", "off", *EFFECTS])
 
-        print(f"[DEBUG] Step 3: Set LED 0 to red and send immediately")
-        fresh_keyboard.set_led_by_idx(idx=0, colour=(255, 0, 0))
-        fresh_keyboard.send_leds()
+def set_brightness(val: int):
+    # The library has no brightness control, so brightness is applied to the
+    # colours on their way out (see PostProcess); re-send the current frame
+    val = _clamp(val)
+    if val == postprocess.brightness:
+        return
+    postprocess.set_brightness(val)
+    with framebuffer.lock:
+        framebuffer.mark_all()
+    request_flush()
 
-        time.sleep(2)
+def set_hue(val: int):
+    # Rotate every colour's hue by val/256 of a turn (0 = unchanged)
+    val = _clamp(val)
+    if val == postprocess.hue:
+        return
+    postprocess.set_hue(val)
+    with framebuffer.lock:
+        framebuffer.mark_all()
+    request_flush()
+
+# ----- LED backends -----
+# A backend turns framebuffer changes into keyboard I/O.
+#  - LibraryBackend drives the RPiKeyboardConfig instance in-process (fast).
+#  - CliBackend shells out to `rpi-keyboard-config` (slow, but independent of
+#    the Python library; useful as a fallback or for debugging).
+#
+# commit(leds, matrix) receives the LEDs that changed since the last commit:
+#   leds   - [(idx, (r, g, b)), ...]
+#   matrix - [(row, col, (r, g, b)), ...] for positions with no known LED index
+# Colours are plain RGB (0..255); each backend converts to what it needs.
+
+class LibraryBackend:
+    """Drive the keyboard in-process through the DeviceManager's handle.
+
+    Direct LED mode is entered once and remembered, so a commit costs a few
+    in-memory writes plus a single `send_leds()`. A failing commit reports
+    the handle as lost, so the next one reopens it.
+    """
 
-        print(f"[DEBUG] Step 4: Try setting first 5 LEDs")
-        for i in range(5):
-            print(f"[DEBUG] Setting LED {i} to red")
-            fresh_keyboard.set_led_by_idx(idx=i, colour=(255, 0, 0))
+    name = "library"
 
-        fresh_keyboard.send_leds()
-        print(f"[DEBUG] First 5 LEDs should be red now!")
+    def __init__(self, manager: Optional[DeviceManager] = None):
+        self.device = manager or device
+        self._direct = False
 
-        time.sleep(3)
+    def reset(self):
+        # Something else (e.g. a hardware effect) changed the mode
+        self._direct = False
 
-        print(f"[DEBUG] Step 5: Try all LEDs")
-        for i in range(85):
-            fresh_keyboard.set_led_by_idx(idx=i, colour=(255, 0, 0))
+    def commit(self, leds, matrix):
+        keyboard = self.device.open()
+        try:
+            if not self._direct:
+                keyboard.set_led_direct_effect()
+                self._direct = True
+            for idx, rgb in leds:
+                keyboard.set_led_by_idx(idx=idx, colour=_rgb_to_keyboard_bgr(*rgb))
+            for row, col, rgb in matrix:
+                keyboard.set_led_by_matrix(matrix=[row, col], colour=_rgb_to_keyboard_bgr(*rgb))
+            keyboard.send_leds()
+        except Exception as e:
+            self._direct = False
+            self.device.lost(e)
+            raise
 
-        fresh_keyboard.send_leds()
-        print(f"[DEBUG] All LEDs should be red now!")
+def _rgb_hex(rgb: Tuple[int, int, int]) -> str:
+    return f"#{rgb[0]:02x}{rgb[1]:02x}{rgb[2]:02x}"
 
-    except Exception as e:
-        print(f"[DEBUG] LED operation failed with fresh instance: {e}")
-        print(f"[DEBUG] Trying simple approach with rgb_clear + direct set")
-        try:
-            # Try a different approach - clear first, then set
-           
-            time.sleep(0.2)
+class CliBackend:
+    """Drive the keyboard through the `rpi-keyboard-config` command line tool.
 
-            simple_keyboard = RPiKeyboardConfig()
-            simple_keyboard.rgb_clear()
-            time.sleep(0.1)
-            simple_keyboard.set_led_direct_effect()
+    Like LibraryBackend it remembers being in Direct mode, so `effect Direct`
+    is only run before the first commit and after a failed command.
 
-            # Set just first few LEDs to test
-            for i in range(min(10, 85)):
-                simple_keyboard.set_led_by_idx(idx=i, colour=rgb)
+    The tool addresses single LEDs as `led set row,col`, so LEDs written by
+    index need their position in LED_INDEX. Without one they can only be
+    sent as part of a whole board in one colour (`leds set`); otherwise
+    they are skipped, with a warning.
+    """
 
-            simple_keyboard.send_leds()
-            print(f"[DEBUG] LED update completed with simple approach")
+    name = "cli"
+
+    def __init__(self, command: str = "rpi-keyboard-config", timeout: float = 5):
+        self.command = command
+        self.timeout = timeout
+        self._direct = False
+        self.frame = bytearray(FRAME_SIZE)  # colours sent by index, to spot a one-colour board
+        self._by_position = False  # LEDs set by row,col since the last whole-board command
+        self._warned = False
+
+    def _run(self, *args: str) -> subprocess.CompletedProcess:
+        result = subprocess.run([self.command, *args],
+                                capture_output=True, text=True, timeout=self.timeout)
+        if result.returncode != 0:
+            # The keyboard's state is unknown now; set the mode again next time
+            self._direct = False
+            log.warning("CLI %s failed: %s", " ".join(args), result.stderr.strip())
+        return result
+
+    def ensure_direct(self):
+        # Set to Direct effect mode first to preserve other LEDs
+        if not self._direct:
+            self._direct = self._run('effect', 'Direct').returncode == 0
+
+    def reset(self):
+        self._direct = False
+
+    def commit(self, leds, matrix):
+        self.ensure_direct()
+        for idx, rgb in leds:
+            self.frame[idx * 3:idx * 3 + 3] = bytes(rgb)
+        positions = {idx: f"{row},{col}" for (row, col), idx in LED_INDEX.items()}
+        unplaced = sum(idx not in positions for idx, _ in leds)
+        whole = len(leds) == LED_COUNT or (unplaced and not self._by_position)
+        if leds and whole and not matrix and self.frame == self.frame[:3] * LED_COUNT:
+            # Whole board in one colour - one command instead of 85
+            if not any(self.frame[:3]):
+                self._run('leds', 'clear')
+            else:
+                self._run('leds', 'set', '-c', _rgb_hex(tuple(self.frame[:3])))
+            self._by_position = False
+            return
+        if unplaced and not self._warned:
+            log.warning("CLI backend: %d LEDs have no known row,col (LED_INDEX) and are skipped; "
+                        "only whole-board colours reach them", unplaced)
+            self._warned = True
+        for idx, rgb in leds:
+            if idx in positions:
+                self._run('led', 'set', positions[idx], '-c', _rgb_hex(rgb))
+        for row, col, rgb in matrix:
+            self._run('led', 'set', f"{row},{col}", '-c', _rgb_hex(rgb))
+        if matrix:
+            self._by_position = True
+
+class MockBackend:
+    """Record commits instead of writing to a keyboard (tests, benchmarks).
+
+    `frame` holds what the keyboard would show; `commits` keeps the most
+    recent commits as (leds, matrix) for inspection.
+    """
 
-        except Exception as e2:
-            print(f"[DEBUG] All LED operations failed: {e2}")
-            raise
+    name = "mock"
+
+    def __init__(self, history: int = 1000):
+        self.frame = bytearray(FRAME_SIZE)
+        self.matrix: dict[tuple[int, int], Tuple[int, int, int]] = {}
+        self.commits = deque(maxlen=history)
+        self.writes = 0
+
+    def reset(self):
+        pass
+
+    def commit(self, leds, matrix):
+        for idx, rgb in leds:
+            self.frame[idx * 3:idx * 3 + 3] = bytes(rgb)
+        for row, col, rgb in matrix:
+            self.matrix[(row, col)] = rgb
+        self.commits.append((leds, matrix))
+        self.writes += 1
+
+BACKENDS = {
+    LibraryBackend.name: LibraryBackend,
+    CliBackend.name: CliBackend,
+    MockBackend.name: MockBackend,
+}
 
-def leds_set_all(colour: str):
-    print(f"[DEBUG] Setting all LEDs to color: {colour} using CLI")
+def make_backend(name: str):
     try:
+        return BACKENDS[name.lower()]()
+    except KeyError:
+        raise ValueError(f"Unknown LED backend '{name}' (choose from: {', '.join(BACKENDS)})")
+
+backend = make_backend(LED_BACKEND)
+
+def use_backend(name: str):
+    """Switch to another LED backend; the current frame is re-sent through it."""
+    global backend
+    backend = make_backend(name)
+    committed.invalidate()
+    with framebuffer.lock:
+        framebuffer.mark_all()
+    return backend
+
+class CommittedState:
+    """What the keyboard is showing: the colours of the last successful commits.
+
+    flush() drops changes that would write the colour an LED already shows,
+    e.g. a retained message re-sent on reconnect or a periodic state sync,
+    and skips the device write entirely when nothing is left. Whenever the
+    keyboard's state is unknown (new backend, reconnect, failed write) the
+    state is invalidated and everything is written again.
+    """
 
-        # Parse color and convert to format for CLI
-        if colour.lower() in ["red", "green", "blue", "white", "black", "yellow", "cyan", "magenta", "orange", "purple", "pink"]:
-            color_arg = colour.lower()
-        elif colour.startswith("#") and len(colour) == 7:
-            # Use hex format directly
-            color_arg = colour
-        elif colour.startswith("rgb("):
-            # Extract RGB values and convert to hex
-            rgb_str = colour[4:-1]
-            parts = [int(x.strip()) for x in rgb_str.split(",")]
-            color_arg = f"#{parts[0]:02x}{parts[1]:02x}{parts[2]:02x}"
-        else:
-            # Default to red if we can't parse
-            color_arg = "red"
+    def __init__(self, count: int = LED_COUNT):
+        self.frame = bytearray(count * 3)
+        self.known = bytearray(count)  # 1 where frame holds the keyboard's colour
+        self.matrix: dict[tuple[int, int], Tuple[int, int, int]] = {}
+
+    def invalidate(self):
+        self.known[:] = bytes(len(self.known))
+        self.matrix.clear()
+
+    def changed(self, leds, matrix):
+        """The (leds, matrix) changes that differ from what is shown."""
+        frame, known = self.frame, self.known
+        leds = [(idx, rgb) for idx, rgb in leds
+                if not known[idx] or frame[idx * 3:idx * 3 + 3] != bytes(rgb)]
+        matrix = [(row, col, rgb) for row, col, rgb in matrix
+                  if self.matrix.get((row, col)) != rgb]
+        return leds, matrix
+
+    def update(self, leds, matrix):
+        # Writes by index and by position reach the same LEDs, so a write
+        # through one makes what the other remembers about that LED stale.
+        # Where LED_INDEX doesn't say which LED a write hit, forget them all.
+        if leds and self.matrix:
+            if len(leds) == len(self.known):
+                self.matrix.clear()
+            else:
+                position = {idx: rc for rc, idx in LED_INDEX.items()}
+                for idx, _ in leds:
+                    if idx not in position:
+                        self.matrix.clear()
+                        break
+                    self.matrix.pop(position[idx], None)
+        for idx, rgb in leds:
+            self.frame[idx * 3:idx * 3 + 3] = bytes(rgb)
+            self.known[idx] = 1
+        for row, col, rgb in matrix:
+            idx = LED_INDEX.get((row, col))
+            if idx is None:
+                self.known[:] = bytes(len(self.known))
+            else:
+                self.known[idx] = 0
+            self.matrix[(row, col)] = rgb
 
-        # Set to Direct effect mode first for consistent behavior
-        effect_result = subprocess.run(['rpi-keyboard-config', 'effect', 'Direct'],
-                                     capture_output=True, text=True, timeout=5)
-        print(f"[DEBUG] Set Direct effect: {effect_result.returncode}")
+committed = CommittedState()
 
-        print(f"[DEBUG] Using CLI command: rpi-keyboard-config leds set -c {color_arg}")
+# ----- Framebuffer -----
+# Optional: map (row,col) → LED index. Positions found here are tracked in the
+# framebuffer by index; anything else is written by matrix position.
+LED_INDEX: dict[tuple[int, int], int] = {}
 
-        # Skip clear step for faster response - just set the color directly
-        result = subprocess.run(['rpi-keyboard-config', 'leds', 'set', '-c', color_arg],
-                              capture_output=True, text=True, timeout=5)
+class FrameBuffer:
+    """In-memory copy of the LED colours with dirty tracking.
 
-        if result.returncode == 0:
-            print(f"[DEBUG] CLI rgb-all command successful")
-        else:
-            print(f"[DEBUG] CLI rgb-all failed: {result.stderr}")
+    Colours live in one flat bytearray (R, G, B per LED). Writes that change
+    a colour mark the LED dirty; take_changes() hands the dirty set to the
+    backend so a flush only pushes what changed.
+    """
 
-    except Exception as e:
-        print(f"[DEBUG] CLI LED operation failed: {e}")
-        raise
+    def __init__(self, count: int = LED_COUNT):
+        self.count = count
+        # Held by writers and by the flush that takes their changes
+        self.lock = threading.Lock()
+        self.pixels = bytearray(count * 3)
+        self.dirty: set[int] = set()
+        # (row, col) → rgb for positions without a known LED index
+        self.matrix: dict[tuple[int, int], Tuple[int, int, int]] = {}
+        self.matrix_dirty: set[tuple[int, int]] = set()
+
+    def get(self, idx: int) -> Tuple[int, int, int]:
+        i = idx * 3
+        px = self.pixels
+        return px[i], px[i + 1], px[i + 2]
+
+    def set(self, idx: int, rgb: Tuple[int, int, int]) -> bool:
+        if not 0 <= idx < self.count:
+            raise ValueError(f"LED index {idx} out of range 0..{self.count - 1}")
+        i = idx * 3
+        if self.pixels[i:i + 3] == bytes(rgb):
+            return False
+        self.pixels[i:i + 3] = bytes(rgb)
+        self.dirty.add(idx)
+        return True
+
+    def set_rc(self, row: int, col: int, rgb: Tuple[int, int, int]) -> bool:
+        idx = LED_INDEX.get((row, col))
+        if idx is not None:
+            return self.set(idx, rgb)
+        if self.matrix.get((row, col)) == rgb:
+            return False
+        self.matrix[(row, col)] = rgb
+        self.matrix_dirty.add((row, col))
+        return True
+
+    def fill(self, rgb: Tuple[int, int, int]):
+        self.pixels[:] = bytes(rgb) * self.count
+        self.dirty.update(range(self.count))
+        # The fill covers every LED, including those only known by position
+        self.matrix.clear()
+        self.matrix_dirty.clear()
+
+    def load(self, frame) -> int:
+        """Copy a packed RGB frame (LED 0 first) into the buffer.
+
+        `frame` can be any bytes-like object; it is compared and copied
+        through memoryviews, so only changed LEDs are marked dirty and no
+        per-LED tuples are built. Returns the number of LEDs that changed.
+        """
+        src = memoryview(frame)
+        if src.nbytes != len(self.pixels):
+            raise ValueError(f"Frame must be {len(self.pixels)} bytes, got {src.nbytes}")
+        # A frame covers every LED, including those only known by position
+        self.matrix.clear()
+        self.matrix_dirty.clear()
+        if self.pixels == src:
+            return 0
+        dst = memoryview(self.pixels)
+        changed = [idx for idx in range(self.count)
+                   if dst[idx * 3:idx * 3 + 3] != src[idx * 3:idx * 3 + 3]]
+        dst[:] = src
+        self.dirty.update(changed)
+        return len(changed)
+
+    def write(self, leds: list[int], data: bytes) -> int:
+        """Store packed RGB `data` for the LEDs in `leds` (in that order).
+
+        Returns the number of LEDs that changed.
+        """
+        px = self.pixels
+        changed = 0
+        for n, idx in enumerate(leds):
+            i = idx * 3
+            rgb = data[n * 3:n * 3 + 3]
+            if px[i:i + 3] != rgb:
+                px[i:i + 3] = rgb
+                self.dirty.add(idx)
+                changed += 1
+        return changed
+
+    def mark_all(self):
+        self.dirty.update(range(self.count))
+        self.matrix_dirty.update(self.matrix)
+
+    def take_changes(self, post=None, layers=None):
+        """Return and clear the pending changes as (leds, matrix) lists.
+
+        With `layers` (a Compositor) and/or `post` (a PostProcess) the
+        colours are the composited and processed output, not the stored
+        values.
+        """
+        px = self.pixels if layers is None else layers.apply(self.pixels)
+        px = px if post is None else post.apply(px)
+        leds = [(idx, (px[idx * 3], px[idx * 3 + 1], px[idx * 3 + 2]))
+                for idx in sorted(self.dirty)]
+        matrix = [(row, col, self.matrix[(row, col)] if post is None else post.apply_rgb(self.matrix[(row, col)]))
+                  for row, col in sorted(self.matrix_dirty)]
+        self.dirty.clear()
+        self.matrix_dirty.clear()
+        return leds, matrix
+
+framebuffer = FrameBuffer()
+
+def _replay_framebuffer():
+    # A reopened keyboard has lost our colours - send everything again.
+    # This runs inside a flush, so only ask the render loop for another one.
+    committed.invalidate()
+    with framebuffer.lock:
+        framebuffer.mark_all()
+    if renderer is not None:
+        renderer.request()
+
+device.on_reconnect.append(_replay_framebuffer)
+
+class PostProcess:
+    """Global colour stages applied to the whole frame at flush time.
+
+    Each stage is a precomputed lookup table, rebuilt only when its setting
+    changes, so a flush never does per-LED float math:
+      - hue: rotation about the grey axis. Being linear in R, G and B, it is
+        stored as one 256-entry table per input channel holding that
+        channel's (dR, dG, dB) contribution.
+      - brightness: one 256-entry table, applied with bytes.translate().
+    """
 
-def led_set_rc(row: int, col: int, colour: str):
-    print(f"[DEBUG] Setting LED at row={row}, col={col} to color: {colour} using CLI")
-    try:
+    def __init__(self):
+        self.brightness = 255
+        self.hue = 0
+        self._brightness_lut = bytes(range(256))
+        self._hue_luts = None
 
-        # Parse color same as leds_set_all
-        if colour.lower() in ["red", "green", "blue", "white", "black", "yellow", "cyan", "magenta", "orange", "purple", "pink"]:
-            color_arg = colour.lower()
-        elif colour.startswith("#") and len(colour) == 7:
-            color_arg = colour
-        elif colour.startswith("rgb("):
-            rgb_str = colour[4:-1]
-            parts = [int(x.strip()) for x in rgb_str.split(",")]
-            color_arg = f"#{parts[0]:02x}{parts[1]:02x}{parts[2]:02x}"
-        else:
-            color_arg = "red"
+    @property
+    def active(self) -> bool:
+        return self.brightness != 255 or self._hue_luts is not None
 
-        # Use row,col format as position
-        position = f"{row},{col}"
+    def set_brightness(self, val: int):
+        self.brightness = val
+        self._brightness_lut = bytes(x * val // 255 for x in range(256))
 
-        # Set to Direct effect mode first to preserve other LEDs
-        effect_result = subprocess.run(['rpi-keyboard-config', 'effect', 'Direct'],
-                                     capture_output=True, text=True, timeout=5)
-        print(f"[DEBUG] Set Direct effect: {effect_result.returncode}")
+    def set_hue(self, val: int):
+        self.hue = val
+        if val == 0:
+            self._hue_luts = None
+            return
+        angle = val / 256 * 2 * math.pi
+        cos, sin = math.cos(angle), math.sin(angle)
+        a = cos + (1 - cos) / 3
+        b = (1 - cos) / 3 - math.sqrt(1 / 3) * sin
+        c = (1 - cos) / 3 + math.sqrt(1 / 3) * sin
+        # R' = aR + bG + cB, G' = cR + aG + bB, B' = bR + cG + aB
+        self._hue_luts = tuple(
+            tuple((round(x * m0), round(x * m1), round(x * m2)) for x in range(256))
+            for m0, m1, m2 in ((a, c, b), (b, a, c), (c, b, a))
+        )
+
+    def apply(self, pixels) -> bytes:
+        out = bytes(pixels)
+        if self._hue_luts is not None:
+            r_lut, g_lut, b_lut = self._hue_luts
+            rotated = bytearray(len(out))
+            for i in range(0, len(out), 3):
+                r0, g0, b0 = r_lut[out[i]]
+                r1, g1, b1 = g_lut[out[i + 1]]
+                r2, g2, b2 = b_lut[out[i + 2]]
+                rotated[i] = _CLIP[r0 + r1 + r2]
+                rotated[i + 1] = _CLIP[g0 + g1 + g2]
+                rotated[i + 2] = _CLIP[b0 + b1 + b2]
+            out = bytes(rotated)
+        if self.brightness != 255:
+            out = out.translate(self._brightness_lut)
+        return out
+
+    def apply_rgb(self, rgb: Tuple[int, int, int]) -> Tuple[int, int, int]:
+        return tuple(self.apply(bytes(rgb)))
+
+# Clamp a hue-rotated channel sum (always within -256..511) to 0..255;
+# negative indices wrap round to the zero-filled tail
+_CLIP = bytes(range(256)) + bytes([255] * 256) + bytes(256)
+
+postprocess = PostProcess()
+
+# ----- Layers -----
+
+class Layer:
+    def __init__(self, name: str, z: int = 0):
+        self.name = name
+        self.z = z
+        self.opacity = 255
+        self.pixels = bytearray(FRAME_SIZE)
+        self.alpha = bytearray(LED_COUNT)  # per-LED coverage; 0 = see through
+
+    def visible(self) -> list[int]:
+        return [idx for idx, a in enumerate(self.alpha) if a]
+
+class Compositor:
+    """Named layers drawn over the framebuffer when it is flushed.
+
+    The framebuffer is the bottom layer: plain LED writes, effects, clips
+    and fades all draw there. Layers stack on top of it by z (then by age),
+    each with an opacity and a per-LED alpha mask, so e.g. a per-key
+    highlight survives a new background colour or effect. Compositing
+    happens once per flush over the whole frame (with NumPy when installed),
+    and a layer change only marks the LEDs it covers dirty, so layers add no
+    extra keyboard writes. Layers are changed under framebuffer.lock.
+    """
 
-        print(f"[DEBUG] Using CLI command: rpi-keyboard-config led set {position} -c {color_arg}")
+    def __init__(self, limit: int = MAX_LAYERS):
+        self.limit = limit
+        self.layers: dict[str, Layer] = {}
+        self.order: list[Layer] = []  # bottom to top
+
+    @property
+    def active(self) -> bool:
+        return bool(self.order)
+
+    def _layer(self, name: str) -> Layer:
+        layer = self.layers.get(name)
+        if layer is None:
+            if len(self.layers) >= self.limit:
+                raise ValueError(f"Too many layers (MAX_LAYERS = {self.limit})")
+            layer = self.layers[name] = Layer(name)
+            self._restack()
+        return layer
+
+    def _restack(self):
+        self.order = sorted(self.layers.values(), key=lambda layer: layer.z)
+
+    def _changed(self, leds):
+        framebuffer.dirty.update(leds)
+
+    def paint(self, name: str, leds: list[int], data: bytes, alpha: int = 255):
+        """Set packed RGB `data` for `leds` on a layer, covering them with `alpha`."""
+        with framebuffer.lock:
+            layer = self._layer(name)
+            for n, idx in enumerate(leds):
+                layer.pixels[idx * 3:idx * 3 + 3] = data[n * 3:n * 3 + 3]
+                layer.alpha[idx] = alpha
+            self._changed(leds)
+        request_flush()
+
+    def set_mask(self, name: str, mask: bytes):
+        if len(mask) != LED_COUNT:
+            raise ValueError(f"Mask must be {LED_COUNT} bytes, got {len(mask)}")
+        with framebuffer.lock:
+            layer = self._layer(name)
+            self._changed(idx for idx in range(LED_COUNT) if layer.alpha[idx] != mask[idx])
+            layer.alpha[:] = mask
+        request_flush()
+
+    def set_opacity(self, name: str, opacity: int):
+        with framebuffer.lock:
+            layer = self._layer(name)
+            layer.opacity = _clamp(opacity)
+            self._changed(layer.visible())
+        request_flush()
+
+    def set_z(self, name: str, z: int):
+        with framebuffer.lock:
+            layer = self._layer(name)
+            layer.z = z
+            self._restack()
+            self._changed(layer.visible())
+        request_flush()
+
+    def load(self, name: str, pixels: bytes, mask: bytes, z: Optional[int] = None):
+        """Replace a layer's colours and mask in one go."""
+        with framebuffer.lock:
+            layer = self._layer(name)
+            if z is not None and layer.z != z:
+                layer.z = z
+                self._restack()
+            old_px, old_alpha = layer.pixels, layer.alpha
+            self._changed(idx for idx in range(LED_COUNT)
+                          if old_alpha[idx] != mask[idx]
+                          or (mask[idx] and old_px[idx * 3:idx * 3 + 3] != pixels[idx * 3:idx * 3 + 3]))
+            layer.pixels[:] = pixels
+            layer.alpha[:] = mask
+        request_flush()
+
+    def clear(self, name: str):
+        """Make a layer fully transparent (it keeps its z and opacity)."""
+        self.set_mask(name, bytes(LED_COUNT))
+
+    def remove(self, name: str):
+        with framebuffer.lock:
+            layer = self.layers.pop(name, None)
+            if layer is None:
+                return
+            self._restack()
+            self._changed(layer.visible())
+        request_flush()
+
+    def apply(self, pixels) -> bytes:
+        np = _numpy()
+        if np:
+            out = np.frombuffer(bytes(pixels), dtype=np.uint8).astype(np.int32).reshape(LED_COUNT, 3)
+            for layer in self.order:
+                k = (np.frombuffer(layer.alpha, dtype=np.uint8).astype(np.int32) * layer.opacity // 255)[:, None]
+                top = np.frombuffer(layer.pixels, dtype=np.uint8).reshape(LED_COUNT, 3)
+                out += (top - out) * k // 255
+            return out.astype(np.uint8).tobytes()
+        out = bytearray(pixels)
+        for layer in self.order:
+            opacity, alpha, top = layer.opacity, layer.alpha, layer.pixels
+            for idx in range(LED_COUNT):
+                a = alpha[idx]
+                if not a:
+                    continue
+                k = a * opacity // 255
+                for i in range(idx * 3, idx * 3 + 3):
+                    out[i] += (top[i] - out[i]) * k // 255
+        return bytes(out)
+
+layers = Compositor()
+metrics.gauge("layers", lambda: len(layers.layers))
+
+def flush() -> int:
+    """Push framebuffer changes to the keyboard in a single backend commit.
+
+    Returns the number of LEDs written (0 if nothing changed).
+    """
+    with framebuffer.lock:
+        leds, matrix = framebuffer.take_changes(postprocess if postprocess.active else None,
+                                                layers if layers.active else None)
+    if not leds and not matrix:
+        return 0
+    pending = len(leds) + len(matrix)
+    leds, matrix = committed.changed(leds, matrix)
+    if pending > len(leds) + len(matrix):
+        metrics.inc("leds_skipped_total", pending - len(leds) - len(matrix))
+    if not leds and not matrix:
+        # The keyboard already shows all of it
+        metrics.inc("writes_skipped_total", backend=backend.name)
+        return 0
+    start = time.perf_counter()
+    try:
+        backend.commit(leds, matrix)
+    except Exception:
+        metrics.inc("backend_errors_total", backend=backend.name)
+        # A failed write may have got partway; assume nothing about the keyboard
+        committed.invalidate()
+        backend.reset()
+        # Keep the changes pending so the next flush retries them
+        with framebuffer.lock:
+            framebuffer.dirty.update(idx for idx, _ in leds)
+            framebuffer.matrix_dirty.update((row, col) for row, col, _ in matrix)
+        raise
+    committed.update(leds, matrix)
+    metrics.observe("backend_write_seconds", time.perf_counter() - start, backend=backend.name)
+    metrics.inc("writes_total", backend=backend.name)
+    metrics.inc("leds_written_total", len(leds) + len(matrix))
+    return len(leds) + len(matrix)
 
-        result = subprocess.run(['rpi-keyboard-config', 'led', 'set', position, '-c', color_arg],
-                              capture_output=True, text=True, timeout=5)
+# ----- Render loop -----
 
-        if result.returncode == 0:
-            print(f"[DEBUG] CLI individual LED command successful")
-        else:
-            print(f"[DEBUG] CLI individual LED failed: {result.stderr}")
+class Renderer(threading.Thread):
+    """Push framebuffer changes to the keyboard, at most `fps` times a second.
 
-    except Exception as e:
-        print(f"[DEBUG] CLI individual LED operation failed: {e}")
-        raise
+    MQTT callbacks only write the framebuffer and call request(); hardware
+    I/O happens here, off the paho network thread. Requests that arrive while
+    a frame is pending fold into that frame, so a flood of messages costs one
+    write per tick and only the latest state reaches the keyboard.
+    """
 
-def info_ascii() -> str:
-    # Convert colour string to RGB tuple and set LED by matrix position
-    rgb = _parse_colour_to_rgb(colour)
-    print(f"[DEBUG] Setting LED at row={row}, col={col} to RGB: {rgb}")
+    def __init__(self, fps: int = MAX_FPS):
+        super().__init__(name="renderer", daemon=True)
+        self.interval = 1.0 / fps
+        self.frames = 0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def request(self):
+        if self._wake.is_set():
+            # Folded into the frame that is already pending
+            metrics.inc("frames_coalesced_total")
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        next_frame = 0.0
+        while not self._stopping.is_set():
+            self._wake.wait(_next_animation(time.monotonic()))
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                self._stopping.wait(delay)
+            self._wake.clear()
+            dispatch_pending()
+            try:
+                now = time.monotonic()
+                for animator in animators:
+                    animator.step(now)
+                if flush():
+                    self.frames += 1
+                    metrics.inc("frames_total")
+            except DeviceUnavailable:
+                # Changes stay pending until the device manager reconnects
+                pass
+            except Exception as e:
+                log.error("Render flush failed: %s", e)
+            next_frame = time.monotonic() + self.interval
+
+class AsyncRenderer:
+    """The render loop for RUNTIME = "asyncio", as tasks on the event loop.
+
+    Same contract as Renderer: request() (safe from any thread) asks for a
+    frame, and requests fold together up to `fps` frames a second. Two
+    tasks share the work. The render task drains the inbox and flushes.
+    The clock task steps the animators when they are due. Backend commits
+    block, so they run on a single-worker executor; the event loop, and
+    with it MQTT I/O and the effects clock, keeps running during a slow
+    or stalled write.
+    """
 
-    try:
-        # Use fresh keyboard instance
-        print(f"[DEBUG] Creating fresh keyboard instance")
-        fresh_keyboard = RPiKeyboardConfig()
+    def __init__(self, fps: int = MAX_FPS):
+        self.interval = 1.0 / fps
+        self.frames = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="keyboard")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake = asyncio.Event()
+        self._tick = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._tasks = [self._loop.create_task(self._render(), name="render"),
+                       self._loop.create_task(self._clock(), name="clock")]
+
+    def is_alive(self) -> bool:
+        return bool(self._tasks) and not self._tasks[0].done()
+
+    def request(self):
+        if self._loop is None:
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._request()
+        else:
+            # e.g. the framebuffer replay after a reconnect, from the executor
+            self._loop.call_soon_threadsafe(self._request)
+
+    def _request(self):
+        if self._wake.is_set():
+            metrics.inc("frames_coalesced_total")
+        self._wake.set()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+    async def _render(self):
+        next_frame = 0.0
+        while True:
+            await self._wake.wait()
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            dispatch_pending()
+            # Cleared after dispatch: handlers request the flush that follows
+            self._wake.clear()
+            self._tick.set()  # a handler may have started or stopped an effect
+            try:
+                if await self._loop.run_in_executor(self.executor, flush):
+                    self.frames += 1
+                    metrics.inc("frames_total")
+            except DeviceUnavailable:
+                pass
+            except Exception as e:
+                log.error("Render flush failed: %s", e)
+            self._tick.set()  # the device may have gone away and needs a retry
+            next_frame = time.monotonic() + self.interval
+
+    async def _clock(self):
+        while True:
+            timeout = _next_animation(time.monotonic())
+            self._tick.clear()
+            try:
+                await asyncio.wait_for(self._tick.wait(), timeout)
+                due = False
+            except asyncio.TimeoutError:
+                due = True
+            now = time.monotonic()
+            drew = [animator.step(now) for animator in animators]
+            if due or any(drew):
+                self.request()
+
+renderer: Optional[Union[Renderer, AsyncRenderer]] = None
+
+# Things that draw into the framebuffer over time (e.g. the effect engine).
+# Each has next_due(now) → seconds until it wants to draw (None when idle)
+# and step(now) → draw if due; the renderer calls them once per tick.
+animators: list = [device]
+
+def _next_animation(now: float) -> Optional[float]:
+    due = [d for d in (a.next_due(now) for a in animators) if d is not None]
+    return min(due) if due else None
+
+def request_flush():
+    """Ask for pending framebuffer changes to be pushed to the keyboard.
+
+    With the render thread running this only wakes it up; without one
+    (e.g. when called from tests) the flush happens immediately.
+    """
+    if threading.current_thread() is renderer:
+        # Handling a queued message: the renderer flushes later this tick
+        return
+    if renderer is not None and renderer.is_alive():
+        renderer.request()
+    else:
+        flush()
+
+def _stop_animations(leds: Optional[list[int]] = None):
+    # The newest write wins over an effect or clip, and over fades on the same LEDs
+    effects.stop()
+    player.stop()
+    fades.cancel(leds)
 
-        print(f"[DEBUG] Setting LED direct effect mode")
-        fresh_keyboard.set_led_direct_effect()
+def _split_transition(payload: str) -> tuple[str, float]:
+    """Take the optional fade time off a colour payload.
 
-        print(f"[DEBUG] Setting LED by matrix position [{row}, {col}]")
-        fresh_keyboard.set_led_by_matrix(matrix=[row, col], colour=rgb)
+    JSON payloads may carry "transition" (seconds), either next to the
+    colour fields ({"r":255,"g":0,"b":0,"transition":2}) or with the colour
+    under "colour" ({"colour":"red","transition":2}). Returns (colour, seconds).
+    """
+    if not payload.startswith("{"):
+        return payload, 0.0
+    obj = json.loads(payload)
+    if not isinstance(obj, dict) or ("transition" not in obj and "colour" not in obj and "color" not in obj):
+        return payload, 0.0
+    transition = _transition_seconds(obj.pop("transition", 0))
+    colour = obj.pop("colour", obj.pop("color", None))
+    if colour is None:
+        colour = obj
+    return (json.dumps(colour) if isinstance(colour, dict) else str(colour)), transition
+
+def _transition_seconds(value) -> float:
+    seconds = float(value)
+    if not 0 <= seconds <= MAX_TRANSITION:
+        raise ValueError(f"transition must be 0..{MAX_TRANSITION} seconds")
+    return seconds
 
-        print(f"[DEBUG] Sending LED data to keyboard")
-        fresh_keyboard.send_leds()
-        print(f"[DEBUG] LED update complete")
+def leds_clear():
+    log.debug("Clearing all LEDs")
+    _stop_animations()
+    with framebuffer.lock:
+        framebuffer.fill((0, 0, 0))
+    request_flush()
 
-    except Exception as e:
-        print(f"[DEBUG] LED operation failed: {e}")
-        raise
+def decode_frame(payload: bytes, encoding: str = "raw") -> memoryview:
+    """Decode a {BASE}/frame payload into FRAME_SIZE packed RGB bytes.
+
+    encoding: "raw" (the bytes as sent), "base64" or "zlib".
+    """
+    if encoding == "base64":
+        payload = base64.b64decode(payload, validate=True)
+    elif encoding == "zlib":
+        # Bound the output so a malicious payload can't inflate without limit
+        payload = zlib.decompressobj().decompress(payload, FRAME_SIZE + 1)
+    elif encoding != "raw":
+        raise ValueError(f"Unsupported frame encoding '{encoding}'")
+    if len(payload) != FRAME_SIZE:
+        raise ValueError(f"Frame must be {FRAME_SIZE} bytes, got {len(payload)}")
+    return memoryview(payload)
+
+def leds_set_frame(payload: bytes, encoding: str = "raw"):
+    frame = decode_frame(payload, encoding)
+    _stop_animations()
+    with framebuffer.lock:
+        changed = framebuffer.load(frame)
+    if changed:
+        request_flush()
+
+def leds_set_all(colour: str, transition: float = 0):
+    rgb = parse_colour_rgb(colour)
+    log.debug("Setting all LEDs to %s", rgb)
+    if transition > 0:
+        effects.stop()
+        player.stop()
+        with framebuffer.lock:
+            # A fade covers every LED, like fill() does
+            framebuffer.matrix.clear()
+            framebuffer.matrix_dirty.clear()
+        fades.start(list(range(LED_COUNT)), bytes(rgb) * LED_COUNT, transition)
+        return
+    _stop_animations()
+    with framebuffer.lock:
+        framebuffer.fill(rgb)
+    request_flush()
+
+def led_set_rc(row: int, col: int, colour: str, transition: float = 0):
+    idx = LED_INDEX.get((row, col))
+    if idx is not None:
+        led_set_index(idx, colour, transition)
+        return
+    # Only LEDs with a known index can fade; others change at once
+    rgb = parse_colour_rgb(colour)
+    log.debug("Setting LED at row=%d, col=%d to %s", row, col, rgb)
+    _stop_animations([])  # no index, so no fade of its own to cancel
+    with framebuffer.lock:
+        changed = framebuffer.set_rc(row, col, rgb)
+    if changed:
+        request_flush()
+
+def led_set_index(idx: int, colour: str, transition: float = 0):
+    rgb = parse_colour_rgb(colour)
+    log.debug("Setting LED %d to %s", idx, rgb)
+    if transition > 0:
+        effects.stop()
+        player.stop()
+        fades.start([idx], bytes(rgb), transition)
+        return
+    _stop_animations([idx])
+    with framebuffer.lock:
+        changed = framebuffer.set(idx, rgb)
+    if changed:
+        request_flush()
 
 def info_ascii() -> str:
+    """The keyboard layout as drawn by `rpi-keyboard-config info --ascii`."""
     # ASCII layout info is not available via library
-    return "Use keyboard.model and keyboard.variant for basic info"
+    result = subprocess.run(["rpi-keyboard-config", "info", "--ascii"],
+                            capture_output=True, text=True, timeout=10)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or "rpi-keyboard-config info failed")
+    return result.stdout
 
 def _clamp(x: int) -> int:
     return max(0, min(255, int(x)))
 
+# ----- Colours -----
+# Every colour payload goes through parse_colour_rgb(), which returns a plain
+# (r, g, b) tuple and is memoized on the payload string: automations tend to
+# repeat the same handful of colours, so after the first message a colour
+# costs a dict lookup. Conversions use precomputed tables instead of float math.
+
+COLOUR_CACHE_SIZE = 256
+
+NAMED_COLOURS = {
+    "red": (255, 0, 0),
+    "green": (0, 255, 0),
+    "blue": (0, 0, 255),
+    "white": (255, 255, 255),
+    "black": (0, 0, 0),
+    "yellow": (255, 255, 0),
+    "cyan": (0, 255, 255),
+    "magenta": (255, 0, 255),
+    "orange": (255, 165, 0),
+    "purple": (128, 0, 128),
+    "pink": (255, 192, 203),
+}
+
+def _keyboard_level(x: int) -> int:
+    # Scale down to prevent saturation - max value around 32 works well
+    scaled = int(x * 32 / 255)
+    # Ensure minimum value of 1 for non-zero inputs to avoid complete darkness
+    return 1 if x > 0 and scaled == 0 else scaled
+
+# 0..255 → keyboard drive level, see _rgb_to_keyboard_bgr
+_KEYBOARD_LEVELS = bytes(_keyboard_level(x) for x in range(256))
+
 def _rgb_to_keyboard_bgr(r: int, g: int, b: int) -> Tuple[int, int, int]:
     """Convert RGB values to BGR format with proper scaling for keyboard hardware.
 
     The keyboard uses BGR order and saturates at high intensities.
     Scale down values to prevent saturation to white.
     """
-    # Scale down to prevent saturation - max value around 32 works well
-    scale_factor = 32 / 255
+    levels = _KEYBOARD_LEVELS
+    return levels[b], levels[g], levels[r]
+
+# (h, s) → RGB at full value, 3 bytes per entry; built on first HSV colour
+_hsv_table: Optional[bytearray] = None
+
+def _build_hsv_table() -> bytearray:
+    table = bytearray(256 * 256 * 3)
+    i = 0
+    for h in range(256):
+        hf = h / 255.0 * 6.0
+        sector = int(hf)
+        f = hf - sector
+        for s in range(256):
+            sf = s / 255.0
+            p = 1 - sf
+            q = 1 - sf * f
+            t = 1 - sf * (1 - f)
+            if s == 0:
+                rgb = (1.0, 1.0, 1.0)
+            elif sector == 0:
+                rgb = (1.0, t, p)
+            elif sector == 1:
+                rgb = (q, 1.0, p)
+            elif sector == 2:
+                rgb = (p, 1.0, t)
+            elif sector == 3:
+                rgb = (p, q, 1.0)
+            elif sector == 4:
+                rgb = (t, p, 1.0)
+            else:
+                rgb = (1.0, p, q)
+            table[i] = int(rgb[0] * 255)
+            table[i + 1] = int(rgb[1] * 255)
+            table[i + 2] = int(rgb[2] * 255)
+            i += 3
+    return table
+
+def _get_hsv_table() -> bytearray:
+    global _hsv_table
+    if _hsv_table is None:
+        _hsv_table = _build_hsv_table()
+    return _hsv_table
+
+def hsv_to_rgb(h: int, s: int, v: int) -> Tuple[int, int, int]:
+    """HSV → RGB, all channels 0..255."""
+    i = (_clamp(h) * 256 + _clamp(s)) * 3
+    v = _clamp(v)
+    table = _get_hsv_table()
+    return table[i] * v // 255, table[i + 1] * v // 255, table[i + 2] * v // 255
+
+@functools.lru_cache(maxsize=COLOUR_CACHE_SIZE)
+def parse_colour_rgb(payload: str) -> Tuple[int, int, int]:
+    """
+    Parse a colour payload into an (r, g, b) tuple, 0..255 per channel.
+    Memoized; see _parse_colour_rgb for the accepted formats.
+    """
+    start = time.perf_counter()
+    try:
+        return _parse_colour_rgb(payload)
+    finally:
+        metrics.observe("colour_parse_seconds", time.perf_counter() - start)
 
-    scaled_r = int(r * scale_factor)
-    scaled_g = int(g * scale_factor)
-    scaled_b = int(b * scale_factor)
+def _parse_colour_rgb(payload: str) -> Tuple[int, int, int]:
+    """
+    Parse a colour payload into an (r, g, b) tuple, 0..255 per channel.
+    Accept:
+      - common names: "red"
+      - hex: "#RRGGBB"
+      - "rgb(r,g,b)"
+      - JSON: {"r":255,"g":0,"b":0} or {"h":0,"s":255,"v":255}
+      - HSV CSV: "h,s,v"  (0..255)
+    Also accepts everything parse_colour() returns. Raises ValueError otherwise.
+    """
+    p = payload.strip()
 
-    # Ensure minimum value of 1 for non-zero inputs to avoid complete darkness
-    if r > 0 and scaled_r == 0:
-        scaled_r = 1
-    if g > 0 and scaled_g == 0:
-        scaled_g = 1
-    if b > 0 and scaled_b == 0:
-        scaled_b = 1
+    if p.startswith("{"):
+        obj = json.loads(p)
+        # HSV takes precedence if present
+        if all(k in obj for k in ("h", "s", "v")):
+            return hsv_to_rgb(obj["h"], obj["s"], obj["v"])
+        if all(k in obj for k in ("r", "g", "b")):
+            return _clamp(obj["r"]), _clamp(obj["g"]), _clamp(obj["b"])
+        raise ValueError("JSON must be RGB or HSV")
+
+    if p.startswith("#") and len(p) == 7:
+        try:
+            return int(p[1:3], 16), int(p[3:5], 16), int(p[5:7], 16)
+        except ValueError:
+            raise ValueError(f"Bad hex colour '{p}'")
 
-    # Return in BGR order for the keyboard
-    return (scaled_b, scaled_g, scaled_r)
+    if p.startswith("rgb(") and p.endswith(")"):
+        parts = [int(x) for x in p[4:-1].split(",")]
+        if len(parts) != 3:
+            raise ValueError("rgb() must have 3 numbers")
+        return _clamp(parts[0]), _clamp(parts[1]), _clamp(parts[2])
+
+    if "," in p:
+        parts = [int(x) for x in p.split(",")]
+        if len(parts) != 3:
+            raise ValueError("Colour CSV must have 3 numbers")
+        if not all(0 <= n <= 255 for n in parts):
+            raise ValueError("CSV numbers must be 0..255")
+        return hsv_to_rgb(*parts)
+
+    try:
+        return NAMED_COLOURS[p.lower()]
+    except KeyError:
+        raise ValueError(f"Unsupported colour '{p}'")
 
 def _parse_colour_to_rgb(colour: str) -> Tuple[int, int, int]:
     """Convert various color formats to BGR tuple for the keyboard (which uses BGR, not RGB)."""
+    try:
+        rgb = parse_colour_rgb(colour)
+    except ValueError:
+        # Default to white if we can't parse
+        rgb = (255, 255, 255)
+    return _rgb_to_keyboard_bgr(*rgb)
+
+# ----- Effects -----
+# Effects are computed a whole frame at a time. Per-LED geometry (x position,
+# angle and distance from the centre) is precomputed as 85-byte maps, and
+# each frame is produced by pushing those maps through 256-entry tables with
+# bytes.translate() - no per-LED Python math. HSV → RGB for the frame uses
+# NumPy when it is installed and a table lookup per LED otherwise.
+
+_np = None  # numpy once imported, False if it isn't installed
+
+def _numpy():
+    """Import NumPy on first use (it's optional and slow to import)."""
+    global _np
+    if _np is None:
+        try:
+            import numpy
+            _np = numpy
+        except ImportError:
+            _np = False
+    return _np
+
+# Value passed to an effect for hue or brightness: one value for every LED,
+# or LED_COUNT bytes (one per LED index)
+Channel = Union[int, bytes]
+
+class EffectParams:
+    def __init__(self, speed: Optional[int] = None, hue: Optional[int] = None,
+                 saturation: Optional[int] = None):
+        self.speed = _clamp(128 if speed is None else speed)
+        self.hue = _clamp(0 if hue is None else hue)
+        self.saturation = _clamp(255 if saturation is None else saturation)
+
+    @property
+    def rate(self) -> float:
+        """Animation speed in turns (256 steps) per second; speed 128 = 0.5."""
+        return self.speed / 256
+
+# name → fn(t, params, geometry) returning (hue, value) Channels
+EFFECTS: dict[str, Callable] = {}
+# name → frame rate cap for effects that change slower than MAX_FPS
+EFFECT_FPS: dict[str, float] = {}
+
+def effect(name: str, fps: Optional[float] = None):
+    """Register an effect function under `name`, optionally with its own frame rate cap."""
+    def register(fn):
+        EFFECTS[name] = fn
+        if fps is not None:
+            EFFECT_FPS[name] = fps
+        return fn
+    return register
+
+# One full sine period over 0..255, scaled to 0..255
+_SINE = bytes(round((math.sin(i / 256 * 2 * math.pi) + 1) * 127.5) for i in range(256))
+
+def _rotated(table: bytes, offset: int) -> bytes:
+    """`table` shifted by `offset` steps, for bytes.translate()."""
+    offset &= 255
+    return table[offset:] + table[:offset]
+
+_IDENTITY = bytes(range(256))
+# Two sine periods over 0..255: two rings between the centre and the edge
+_RINGS = bytes(_SINE[(i * 2) & 255] for i in range(256))
+
+def led_positions() -> list[tuple[float, float]]:
+    """(x, y) of each LED index, scaled to 0..1.
+
+    Uses LED_INDEX where it knows the position; other LEDs are assumed to be
+    laid out row by row, 15 to a row.
+    """
+    known = {idx: rc for rc, idx in LED_INDEX.items()}
+    rc = [known.get(idx, divmod(idx, 15)) for idx in range(LED_COUNT)]
+    max_row = max(r for r, _ in rc) or 1
+    max_col = max(c for _, c in rc) or 1
+    return [(c / max_col, r / max_row) for r, c in rc]
+
+class Geometry:
+    """Per-LED position maps (0..255 per LED) used by the effects."""
+
+    def __init__(self, positions: list[tuple[float, float]]):
+        self.x = bytes(min(255, int(x * 256)) for x, _ in positions)
+        self.y = bytes(min(255, int(y * 256)) for _, y in positions)
+        self.angle = bytes(int((math.atan2(y - 0.5, x - 0.5) / (2 * math.pi) + 0.5) * 256) & 255
+                           for x, y in positions)
+        self.distance = bytes(min(255, int(math.hypot(x - 0.5, y - 0.5) * 2 * 255))
+                              for x, y in positions)
+
+@effect("solid")
+def _effect_solid(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    return p.hue, 255
+
+@effect("breathe")
+def _effect_breathe(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    return p.hue, _SINE[int(t * p.rate * 256) & 255]
+
+@effect("cycle")
+def _effect_cycle(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    return (p.hue + int(t * p.rate * 256)) & 255, 255
+
+@effect("wave")
+def _effect_wave(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    # Rainbow bands scrolling across the keyboard
+    return g.x.translate(_rotated(_IDENTITY, p.hue - int(t * p.rate * 256))), 255
+
+@effect("spiral")
+def _effect_spiral(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    # Rainbow spinning around the centre
+    return g.angle.translate(_rotated(_IDENTITY, p.hue + int(t * p.rate * 256))), 255
+
+@effect("ripple")
+def _effect_ripple(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    # Rings of light moving out from the centre
+    return p.hue, g.distance.translate(_rotated(_RINGS, -int(t * p.rate * 256)))
+
+def _hsv_frame(hue: Channel, saturation: int, value: Channel) -> bytes:
+    """Pack per-LED HSV into a FRAME_SIZE RGB frame."""
+    if isinstance(hue, int) and isinstance(value, int):
+        return bytes(hsv_to_rgb(hue, saturation, value)) * LED_COUNT
+    hues = hue if isinstance(hue, bytes) else bytes([hue]) * LED_COUNT
+    values = value if isinstance(value, bytes) else bytes([value]) * LED_COUNT
+    np = _numpy()
+    if np:
+        table = np.frombuffer(_get_hsv_table(), dtype=np.uint8).reshape(256, 256, 3)
+        rgb = table[np.frombuffer(hues, dtype=np.uint8), saturation].astype(np.uint16)
+        rgb *= np.frombuffer(values, dtype=np.uint8)[:, None]
+        return (rgb // 255).astype(np.uint8).tobytes()
+    frame = bytearray(FRAME_SIZE)
+    for idx in range(LED_COUNT):
+        frame[idx * 3:idx * 3 + 3] = bytes(hsv_to_rgb(hues[idx], saturation, values[idx]))
+    return bytes(frame)
+
+class EffectEngine:
+    """Runs the current software effect on the render loop.
+
+    step() draws a frame into the framebuffer when one is due. The engine
+    measures the CPU time each frame takes and stretches the frame interval
+    so effects stay within `budget` (a share of one core), on top of the
+    MAX_FPS cap (or the effect's own cap, see EFFECT_FPS).
+    """
 
-    # Handle JSON format first
-    if colour.startswith("{"):
+    def __init__(self, budget: float = EFFECT_CPU_BUDGET, fps: int = MAX_FPS):
+        self.budget = budget
+        self.fps = fps
+        self.min_interval = 1.0 / fps
+        self.interval = self.min_interval
+        self.name: Optional[str] = None
+        self.params = EffectParams()
+        self.geometry: Optional[Geometry] = None
+        self.cost = 0.0  # smoothed CPU seconds per frame
+        self._started = 0.0
+        self._next_frame = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self.name is not None
+
+    def start(self, name: str, **params):
+        self.params = EffectParams(**params)
+        self.geometry = Geometry(led_positions())
+        _get_hsv_table()  # build it here, not in the first frame's CPU budget
+        self.min_interval = 1.0 / min(self.fps, EFFECT_FPS.get(name, self.fps))
+        self._started = self._next_frame = time.monotonic()
+        self.name = name
+
+    def stop(self):
+        self.name = None
+
+    def next_due(self, now: float) -> Optional[float]:
+        if not self.active:
+            return None
+        return max(0.0, self._next_frame - now)
+
+    def render(self, t: float) -> bytes:
+        hue, value = EFFECTS[self.name](t, self.params, self.geometry)
+        return _hsv_frame(hue, self.params.saturation, value)
+
+    def step(self, now: float) -> bool:
+        name = self.name
+        if name is None or now < self._next_frame:
+            return False
+        cpu = time.thread_time()
+        frame = self.render(now - self._started)
+        with framebuffer.lock:
+            # stop() may have run on another thread while rendering
+            if self.name == name:
+                framebuffer.load(frame)
+        cost = time.thread_time() - cpu
+        self.cost = cost if self.cost == 0 else self.cost * 0.9 + cost * 0.1
+        self.interval = max(self.min_interval, self.cost / self.budget)
+        self._next_frame = now + self.interval
+        return True
+
+effects = EffectEngine()
+animators.append(effects)
+
+metrics.gauge("pending_leds", lambda: len(framebuffer.dirty) + len(framebuffer.matrix_dirty))
+metrics.gauge("colour_cache_hits", lambda: parse_colour_rgb.cache_info().hits)
+metrics.gauge("colour_cache_misses", lambda: parse_colour_rgb.cache_info().misses)
+metrics.gauge("effect_frame_cpu_seconds", lambda: round(effects.cost, 6))
+metrics.gauge("keyboard_connected", lambda: int(device.connected))
+metrics.gauge("keyboard_reconnects", lambda: device.reconnects)
+
+# ----- System metrics -----
+# Effects that show the Pi's own load, so the most common dashboard needs no
+# MQTT traffic at all. The sources keep their /proc files open and re-read
+# them from the start; CPU and network counters are turned into load from
+# the difference between two reads. The effects are capped at one frame per
+# SYSMON_INTERVAL, so /proc is read at that rate whatever MAX_FPS is.
+
+class ProcFile:
+    """A /proc file kept open and re-read from the start on each read()."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._warned = False
+
+    def read(self) -> Optional[str]:
+        """The file's current contents, or None if it can't be read (e.g. not Linux)."""
         try:
-            obj = json.loads(colour)
-            # HSV takes precedence if present
-            if all(k in obj for k in ("h", "s", "v")):
-                h, s, v = obj["h"] / 255.0, obj["s"] / 255.0, obj["v"] / 255.0
-                # HSV to RGB conversion
-                if s == 0:
-                    r = g = b = v
-                else:
-                    h *= 6.0
-                    i = int(h)
-                    f = h - i
-                    p = v * (1 - s)
-                    q = v * (1 - s * f)
-                    t = v * (1 - s * (1 - f))
-
-                    if i == 0:
-                        r, g, b = v, t, p
-                    elif i == 1:
-                        r, g, b = q, v, p
-                    elif i == 2:
-                        r, g, b = p, v, t
-                    elif i == 3:
-                        r, g, b = p, q, v
-                    elif i == 4:
-                        r, g, b = t, p, v
-                    else:
-                        r, g, b = v, p, q
-                r, g, b = int(r * 255), int(g * 255), int(b * 255)
-                return _rgb_to_keyboard_bgr(r, g, b)
-
-            if all(k in obj for k in ("r", "g", "b")):
-                r, g, b = _clamp(obj["r"]), _clamp(obj["g"]), _clamp(obj["b"])
-                return _rgb_to_keyboard_bgr(r, g, b)
-        except (json.JSONDecodeError, KeyError):
-            pass
+            if self._file is None:
+                self._file = open(self.path, "rb")
+            self._file.seek(0)
+            return self._file.read().decode("ascii", "replace")
+        except OSError as e:
+            if not self._warned:
+                log.warning("Can't read %s: %s", self.path, e)
+                self._warned = True
+            self.close()
+            return None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class CpuLoad:
+    """Busy share of all CPUs together and of each core, from /proc/stat."""
+
+    def __init__(self, path: str = "/proc/stat"):
+        self.file = ProcFile(path)
+        self._last: dict[str, tuple[int, int]] = {}  # "cpu", "cpu0".. → (busy, total) jiffies
+        self.total = 0.0
+        self.cores: list[float] = []
+
+    def read(self) -> tuple[float, list[float]]:
+        text = self.file.read()
+        if text is None:
+            return self.total, self.cores
+        loads = {}
+        for line in text.splitlines():
+            if not line.startswith("cpu"):
+                break
+            name, *fields = line.split()
+            # user nice system idle iowait irq softirq steal (guest time is already in user)
+            ticks = [int(v) for v in fields[:8]]
+            total = sum(ticks)
+            busy = total - ticks[3] - (ticks[4] if len(ticks) > 4 else 0)
+            last_busy, last_total = self._last.get(name, (busy, total))
+            self._last[name] = (busy, total)
+            elapsed = total - last_total
+            loads[name] = min(1.0, max(0.0, (busy - last_busy) / elapsed)) if elapsed > 0 else 0.0
+        self.total = loads.pop("cpu", 0.0)
+        self.cores = list(loads.values())
+        return self.total, self.cores
+
+class MemoryUse:
+    """Share of memory in use (not available to new programs), from /proc/meminfo."""
+
+    def __init__(self, path: str = "/proc/meminfo"):
+        self.file = ProcFile(path)
+
+    def read(self) -> float:
+        text = self.file.read()
+        if text is None:
+            return 0.0
+        info = {}
+        for line in text.splitlines():
+            key, _, rest = line.partition(":")
+            fields = rest.split()
+            if fields:
+                info[key] = int(fields[0])
+        total = info.get("MemTotal", 0)
+        available = info.get("MemAvailable", info.get("MemFree", 0))
+        return min(1.0, max(0.0, 1 - available / total)) if total else 0.0
+
+class NetworkLoad:
+    """Receive and transmit rates of every interface but loopback, from /proc/net/dev.
+
+    Rates are shown against `scale` bytes/sec, or against the recent peak
+    (decaying slowly) when no scale is set.
+    """
 
-    # Handle named colors
-    color_map = {
-        "red": (255, 0, 0),
-        "green": (0, 255, 0),
-        "blue": (0, 0, 255),
-        "white": (255, 255, 255),
-        "black": (0, 0, 0),
-        "yellow": (255, 255, 0),
-        "cyan": (0, 255, 255),
-        "magenta": (255, 0, 255),
-        "orange": (255, 165, 0),
-        "purple": (128, 0, 128),
-        "pink": (255, 192, 203),
-    }
+    MIN_SCALE = 16 * 1024  # bytes/sec: keep background chatter from filling the bars
+    DECAY = 0.98  # per read, for the recent peak
+
+    def __init__(self, path: str = "/proc/net/dev", scale: Optional[float] = SYSMON_NET_SCALE):
+        self.file = ProcFile(path)
+        self.scale = scale
+        self._last: Optional[tuple[float, int, int]] = None  # (time, rx bytes, tx bytes)
+        self._peak = float(self.MIN_SCALE)
+        self.rx = self.tx = 0.0
+
+    def read(self, now: Optional[float] = None) -> tuple[float, float]:
+        text = self.file.read()
+        if text is None:
+            return self.rx, self.tx
+        now = time.monotonic() if now is None else now
+        rx = tx = 0
+        for line in text.splitlines()[2:]:  # two header lines
+            name, _, rest = line.partition(":")
+            fields = rest.split()
+            if name.strip() == "lo" or len(fields) < 9:
+                continue
+            rx += int(fields[0])
+            tx += int(fields[8])
+        last, self._last = self._last, (now, rx, tx)
+        if last is None or now <= last[0]:
+            return self.rx, self.tx
+        # Counters go backwards when an interface goes away: show that as idle
+        rx_rate = max(0, rx - last[1]) / (now - last[0])
+        tx_rate = max(0, tx - last[2]) / (now - last[0])
+        scale = self.scale
+        if scale is None:
+            self._peak = scale = max(self.MIN_SCALE, rx_rate, tx_rate, self._peak * self.DECAY)
+        self.rx = min(1.0, rx_rate / scale)
+        self.tx = min(1.0, tx_rate / scale)
+        return self.rx, self.tx
+
+cpu_load = CpuLoad()
+memory_use = MemoryUse()
+network_load = NetworkLoad()
+
+# Bar colour along the keyboard: green on the left to red on the right
+_METER = bytes(85 - i * 85 // 255 for i in range(256))
+_METER_DIM = 24  # brightness of the unlit part of a bar
+
+def _meter_hue(level: float) -> int:
+    """Green (idle) to red (full) for a 0..1 load."""
+    return round(85 * (1 - level))
+
+def _bars(g: Geometry, levels: list[float]) -> tuple[Channel, Channel]:
+    """One horizontal bar per level, stacked top to bottom over the keyboard rows."""
+    n = len(levels)
+    cuts = [round(level * 256) for level in levels]
+    value = bytes(255 if x < cuts[min(n - 1, y * n // 256)] else _METER_DIM
+                  for x, y in zip(g.x, g.y))
+    return g.x.translate(_METER), value
+
+@effect("cpu", fps=1 / SYSMON_INTERVAL)
+def _effect_cpu(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    # One bar per core (or a single bar on a one-core Pi)
+    total, cores = cpu_load.read()
+    return _bars(g, cores if len(cores) > 1 else [total])
+
+@effect("cpu_heatmap", fps=1 / SYSMON_INTERVAL)
+def _effect_cpu_heatmap(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    # The keyboard split into one block of columns per core, green to red by load
+    total, cores = cpu_load.read()
+    cores = cores or [total]
+    hues = bytes(_meter_hue(load) for load in cores)
+    n = len(hues)
+    return bytes(hues[min(n - 1, x * n // 256)] for x in g.x), 255
+
+@effect("memory", fps=1 / SYSMON_INTERVAL)
+def _effect_memory(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    return _bars(g, [memory_use.read()])
+
+@effect("network", fps=1 / SYSMON_INTERVAL)
+def _effect_network(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    # Receive on the top half, transmit on the bottom half
+    return _bars(g, list(network_load.read()))
+
+@effect("sysmon", fps=1 / SYSMON_INTERVAL)
+def _effect_sysmon(t: float, p: EffectParams, g: Geometry) -> tuple[Channel, Channel]:
+    # CPU, memory, network receive and network transmit, top to bottom
+    total, _ = cpu_load.read()
+    return _bars(g, [total, memory_use.read(), *network_load.read()])
+
+# ----- Transitions -----
+
+class Fade:
+    def __init__(self, leds: list[int], src: bytes, dst: bytes, start: float, duration: float):
+        self.leds = leds
+        self.src = src  # packed RGB of `leds` when the fade started
+        self.dst = dst
+        self.start = start
+        self.duration = duration
+
+class Fader:
+    """Server-side colour fades, drawn on the render loop (an animator).
+
+    One message starts one Fade over all the LEDs it touches; each frame the
+    whole fade is blended in a single pass over its packed RGB bytes and
+    written to the framebuffer, at up to `fps` frames a second. Writing an
+    LED that is fading (without a transition) cancels the fade for that LED.
+    """
+
+    def __init__(self, fps: int = MAX_FPS):
+        self.interval = 1.0 / fps
+        self.lock = threading.Lock()
+        self.fades: list[Fade] = []
+        self._next = 0.0
+
+    @property
+    def active(self) -> bool:
+        return bool(self.fades)
+
+    def start(self, leds: list[int], dst: bytes, duration: float):
+        """Fade `leds` from their current colours to packed RGB `dst`."""
+        with self.lock:
+            self._cancel(leds)
+            with framebuffer.lock:
+                px = framebuffer.pixels
+                src = b"".join(px[idx * 3:idx * 3 + 3] for idx in leds)
+            self.fades.append(Fade(leds, src, dst, time.monotonic(), duration))
+            self._next = 0.0
+        request_flush()
+
+    def cancel(self, leds: Optional[list[int]] = None):
+        """Stop fading `leds` (all LEDs if None), leaving their current colour."""
+        if not self.fades:
+            return
+        with self.lock:
+            self._cancel(leds)
+
+    def _cancel(self, leds: Optional[list[int]]):
+        if leds is None:
+            self.fades.clear()
+            return
+        drop = set(leds)
+        kept = []
+        for fade in self.fades:
+            keep = [n for n, idx in enumerate(fade.leds) if idx not in drop]
+            if len(keep) == len(fade.leds):
+                kept.append(fade)
+            elif keep:
+                pick = lambda data: b"".join(data[n * 3:n * 3 + 3] for n in keep)
+                kept.append(Fade([fade.leds[n] for n in keep], pick(fade.src), pick(fade.dst),
+                                 fade.start, fade.duration))
+        self.fades = kept
+
+    def next_due(self, now: float) -> Optional[float]:
+        if not self.fades:
+            return None
+        return max(0.0, self._next - now)
+
+    def step(self, now: float) -> bool:
+        with self.lock:
+            if not self.fades or now < self._next:
+                return False
+            running = []
+            for fade in self.fades:
+                k = min(256, int((now - fade.start) / fade.duration * 256))
+                data = fade.dst if k >= 256 else bytes(
+                    [a + ((b - a) * k >> 8) for a, b in zip(fade.src, fade.dst)])
+                with framebuffer.lock:
+                    framebuffer.write(fade.leds, data)
+                if k < 256:
+                    running.append(fade)
+            self.fades = running
+            self._next = now + self.interval
+        return True
+
+fades = Fader()
+animators.append(fades)
+
+# ----- Clips -----
+# A clip is uploaded once and played back by the bridge. Upload payload: a
+# JSON header line, then the frames ({BASE}/frame format, back to back):
+#   {"fps": 30}\n<frames>   or   {"durations": [100, 50, ...]}\n<frames> (ms per frame)
+# The header may add "encoding": "zlib" if the frames are compressed.
+
+_CLIP_NAME = re.compile(r"[\w.-]{1,64}")
+
+class Clip:
+    def __init__(self, name: str, data, durations: list[float],
+                 path: Optional[str] = None, offset: int = 0):
+        self.name = name
+        self.data = data  # bytes, or an mmap of the file at `path`
+        self.path = path
+        self.offset = offset  # where the frames start in data
+        self.count = (len(data) - offset) // FRAME_SIZE
+        self.ends = list(itertools.accumulate(durations))  # seconds from start to each frame's end
+
+    @property
+    def duration(self) -> float:
+        return self.ends[-1]
+
+    def frame(self, i: int) -> memoryview:
+        start = self.offset + i * FRAME_SIZE
+        return memoryview(self.data)[start:start + FRAME_SIZE]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+def parse_clip(payload: bytes) -> tuple[dict, bytes, list[float]]:
+    """Split an upload into (header, frames, per-frame durations in seconds)."""
+    head, sep, body = bytes(payload).partition(b"\n")
+    if not sep:
+        raise ValueError("Clip needs a JSON header line before the frames")
+    header = json.loads(head)
+    encoding = header.pop("encoding", "raw")
+    if encoding == "zlib":
+        # Bound the output so a malicious payload can't inflate without limit
+        body = zlib.decompressobj().decompress(body, CLIP_MAX_BYTES + 1)
+    elif encoding != "raw":
+        raise ValueError(f"Unsupported clip encoding '{encoding}'")
+    if len(body) > CLIP_MAX_BYTES:
+        raise ValueError(f"Clip larger than {CLIP_MAX_BYTES} bytes")
+    if not body or len(body) % FRAME_SIZE:
+        raise ValueError(f"Clip frames must be a non-empty multiple of {FRAME_SIZE} bytes")
+    count = len(body) // FRAME_SIZE
+    if "durations" in header:
+        durations = [float(ms) / 1000 for ms in header["durations"]]
+        if len(durations) != count:
+            raise ValueError(f"Clip has {count} frames but {len(durations)} durations")
+    else:
+        fps = float(header.get("fps", MAX_FPS))
+        if fps <= 0:
+            raise ValueError("Clip fps must be positive")
+        durations = [1 / fps] * count
+    if min(durations) <= 0:
+        raise ValueError("Clip frame durations must be positive")
+    return header, body, durations
+
+class ClipStore:
+    """Uploaded clips by name. Small clips live in memory; clips of at least
+    `mmap_bytes` are written to `directory` and mapped from there, so they
+    cost page cache rather than heap, and are loaded again by load() at startup.
+    """
 
-    if colour.lower() in color_map:
-        r, g, b = color_map[colour.lower()]
-        return _rgb_to_keyboard_bgr(r, g, b)
+    def __init__(self, directory: str = CLIP_DIR, mmap_bytes: int = CLIP_MMAP_BYTES):
+        self.directory = directory
+        self.mmap_bytes = mmap_bytes
+        self.clips: dict[str, Clip] = {}
+
+    def __len__(self) -> int:
+        return len(self.clips)
+
+    def get(self, name: str) -> Clip:
+        clip = self.clips.get(name)
+        if clip is None:
+            raise ValueError(f"No clip '{name}'")
+        return clip
+
+    def add(self, name: str, payload: bytes) -> Clip:
+        if not _CLIP_NAME.fullmatch(name):
+            raise ValueError(f"Bad clip name '{name}'")
+        header, body, durations = parse_clip(payload)
+        if len(body) < self.mmap_bytes:
+            clip = Clip(name, bytes(body), durations)
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{name}.clip")
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(json.dumps({"durations": [round(d * 1000, 3) for d in durations]}).encode())
+                f.write(b"\n")
+                f.write(body)
+            os.replace(tmp, path)
+            clip = self._map(name, path)
+        # A replaced clip's file goes, unless the new one was just written over it
+        self.remove(name, delete_file=clip.path is None)
+        self.clips[name] = clip
+        return clip
+
+    def _map(self, name: str, path: str) -> Clip:
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        head_len = data.find(b"\n") + 1
+        durations = [float(ms) / 1000 for ms in json.loads(data[:head_len])["durations"]]
+        clip = Clip(name, data, durations, path, head_len)
+        if clip.count != len(durations) or (len(data) - head_len) % FRAME_SIZE:
+            data.close()
+            raise ValueError(f"{path} is truncated")
+        return clip
+
+    def remove(self, name: str, delete_file: bool = True):
+        clip = self.clips.pop(name, None)
+        if clip is None:
+            return
+        if player.clip is clip:
+            player.stop()
+        clip.close()
+        if delete_file and clip.path:
+            os.unlink(clip.path)
+
+    def load(self) -> int:
+        """Map the clips saved in the directory. Returns the number loaded."""
+        try:
+            names = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for filename in names:
+            name, ext = os.path.splitext(filename)
+            if ext != ".clip" or not _CLIP_NAME.fullmatch(name):
+                continue
+            try:
+                self.clips[name] = self._map(name, os.path.join(self.directory, filename))
+            except Exception as e:
+                log.warning("Skipping clip file %s: %s", filename, e)
+        return len(self.clips)
+
+class ClipPlayer:
+    """Plays a clip on the render loop (an animator).
+
+    Frame times are offsets from the monotonic start time, so playback
+    doesn't drift; when the loop is late it shows whichever frame is due
+    now and skips the rest. Once-through playback leaves the last frame up.
+    """
 
-    # Handle rgb(r,g,b) format
-    if colour.startswith("rgb(") and colour.endswith(")"):
-        rgb_str = colour[4:-1]
-        parts = [int(x.strip()) for x in rgb_str.split(",")]
-        return _rgb_to_keyboard_bgr(parts[0], parts[1], parts[2])
+    def __init__(self):
+        self._state: Optional[tuple[Clip, bool, float]] = None  # (clip, loop, start)
+        self._next = 0.0
+        self._shown = -1
+
+    @property
+    def clip(self) -> Optional[Clip]:
+        state = self._state
+        return state[0] if state else None
+
+    def play(self, clip: Clip, loop: bool = False):
+        _stop_animations()
+        self._next = 0.0
+        self._shown = -1
+        self._state = (clip, loop, time.monotonic())
+        self.step(time.monotonic())
+        request_flush()
+
+    def stop(self):
+        self._state = None
+
+    def next_due(self, now: float) -> Optional[float]:
+        if self._state is None:
+            return None
+        return max(0.0, self._next - now)
+
+    def step(self, now: float) -> bool:
+        state = self._state
+        if state is None or now < self._next:
+            return False
+        clip, loop, start = state
+        elapsed = now - start
+        if elapsed >= clip.duration and loop:
+            start += elapsed // clip.duration * clip.duration
+            elapsed = now - start
+        idx = min(bisect.bisect_right(clip.ends, elapsed), clip.count - 1)
+        done = not loop and elapsed >= clip.duration
+        self._next = start + clip.ends[idx]
+        drew = False
+        if idx != self._shown:
+            with framebuffer.lock:
+                # stop() may have run on another thread meanwhile
+                if self._state is state:
+                    framebuffer.load(clip.frame(idx))
+                    drew = True
+            self._shown = idx
+        if done and self._state is state:
+            self._state = None
+        return drew
+
+clips = ClipStore()
+player = ClipPlayer()
+animators.append(player)
+metrics.gauge("clips_stored", lambda: len(clips))
+
+# ----- Notifications -----
+
+class Notification:
+    def __init__(self, id: str, leds: list[int], rgb: Tuple[int, int, int], priority: int,
+                 start: float, expires: float, pattern: str, seq: int):
+        self.id = id
+        self.leds = leds
+        self.rgb = rgb
+        self.priority = priority
+        self.start = start
+        self.expires = expires
+        self.pattern = pattern
+        self.seq = seq
+
+# pattern → fn(seconds shown) giving the alpha 0..255
+NOTIFY_PATTERNS: dict[str, Callable[[float], int]] = {
+    "solid": lambda t: 255,
+    "blink": lambda t: 255 if t % 1.0 < 0.5 else 0,
+    "pulse": lambda t: _SINE[int(t * 256) & 255],
+}
 
-    # Handle HSV h,s,v format - convert to RGB
-    if "," in colour and not colour.startswith("rgb"):
-        parts = [int(x.strip()) for x in colour.split(",")]
-        if len(parts) == 3:
-            # Simple HSV to RGB conversion (h, s, v all 0-255)
-            h, s, v = parts[0] / 255.0, parts[1] / 255.0, parts[2] / 255.0
+class Notifier:
+    """Time-limited overlays shown on their own top layer (an animator).
 
-            if s == 0:
-                r = g = b = v
+    Each LED shows the highest-priority notification covering it (the newest
+    on a tie); when a notification expires the LEDs under it simply show
+    what is beneath again, so nothing has to be restored. Expiry times sit
+    in a heap, so a tick only looks at the notifications that are due; the
+    per-LED winners are recomputed only when the set changes. A notification
+    sent again with the same id replaces the old one.
+    """
+
+    LAYER = "notify"
+    Z = 1 << 20  # above any user layer
+
+    def __init__(self, limit: int = NOTIFY_LIMIT):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.active: dict[str, Notification] = {}
+        self._heap: list[tuple[float, int, str]] = []  # (expires, seq, id); stale entries are skipped
+        self._seq = 0
+        self._winners: list[Optional[Notification]] = [None] * LED_COUNT
+        self._animated = False  # a blink/pulse notification is showing
+        self._next_frame = 0.0
+        self.interval = 1.0 / MAX_FPS
+
+    def __len__(self) -> int:
+        return len(self.active)
+
+    def notify(self, leds: list[int], rgb: Tuple[int, int, int], priority: int = 0,
+               ttl: float = NOTIFY_TTL, pattern: str = "solid", id: Optional[str] = None) -> str:
+        if pattern not in NOTIFY_PATTERNS:
+            raise ValueError(f"Unknown pattern '{pattern}' (choose from: {', '.join(NOTIFY_PATTERNS)})")
+        if not 0 < ttl <= 24 * 3600:
+            raise ValueError("ttl must be 0..86400 seconds")
+        with self.lock:
+            self._seq += 1
+            id = id or f"#{self._seq}"
+            if id not in self.active and len(self.active) >= self.limit:
+                raise ValueError(f"Too many notifications (NOTIFY_LIMIT = {self.limit})")
+            now = time.monotonic()
+            n = Notification(id, leds, rgb, priority, now, now + ttl, pattern, self._seq)
+            self.active[id] = n
+            heapq.heappush(self._heap, (n.expires, n.seq, id))
+            self._update(now)
+        return id
+
+    def cancel(self, id: str):
+        with self.lock:
+            if self.active.pop(id, None) is not None:
+                self._update(time.monotonic())
+
+    def next_due(self, now: float) -> Optional[float]:
+        due = [self._heap[0][0]] if self._heap else []
+        if self._animated:
+            due.append(self._next_frame)
+        return max(0.0, min(due) - now) if due else None
+
+    def step(self, now: float) -> bool:
+        with self.lock:
+            expired = False
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                _, seq, id = heapq.heappop(heap)
+                n = self.active.get(id)
+                if n is not None and n.seq == seq:
+                    del self.active[id]
+                    expired = True
+            if len(heap) > 2 * len(self.active) + 64:
+                # Drop entries left behind by replaced or cancelled notifications
+                self._heap = [(n.expires, n.seq, n.id) for n in self.active.values()]
+                heapq.heapify(self._heap)
+            if expired:
+                self._update(now)
+                return True
+            if self._animated and now >= self._next_frame:
+                self._render(now)
+                return True
+        return False
+
+    def _update(self, now: float):
+        # Paint lowest first so higher priorities (then newer) end up on top
+        winners: list[Optional[Notification]] = [None] * LED_COUNT
+        for n in sorted(self.active.values(), key=lambda n: (n.priority, n.seq)):
+            for idx in n.leds:
+                winners[idx] = n
+        self._winners = winners
+        self._render(now)
+
+    def _render(self, now: float):
+        pixels = bytearray(FRAME_SIZE)
+        mask = bytearray(LED_COUNT)
+        animated = False
+        for idx, n in enumerate(self._winners):
+            if n is None:
+                continue
+            pixels[idx * 3:idx * 3 + 3] = bytes(n.rgb)
+            if n.pattern == "solid":
+                mask[idx] = 255
             else:
-                h *= 6.0
-                i = int(h)
-                f = h - i
-                p = v * (1 - s)
-                q = v * (1 - s * f)
-                t = v * (1 - s * (1 - f))
-
-                if i == 0:
-                    r, g, b = v, t, p
-                elif i == 1:
-                    r, g, b = q, v, p
-                elif i == 2:
-                    r, g, b = p, v, t
-                elif i == 3:
-                    r, g, b = p, q, v
-                elif i == 4:
-                    r, g, b = t, p, v
-                else:
-                    r, g, b = v, p, q
-
-            r, g, b = int(r * 255), int(g * 255), int(b * 255)
-            return _rgb_to_keyboard_bgr(r, g, b)
-
-    # Handle hex format
-    if colour.startswith("#") and len(colour) == 7:
-        r = int(colour[1:3], 16)
-        g = int(colour[3:5], 16)
-        b = int(colour[5:7], 16)
-        return _rgb_to_keyboard_bgr(r, g, b)
-
-    # Default to white if we can't parse
-    return _rgb_to_keyboard_bgr(255, 255, 255)
+                animated = True
+                mask[idx] = NOTIFY_PATTERNS[n.pattern](now - n.start)
+        self._animated = animated
+        self._next_frame = now + self.interval
+        if any(mask):
+            layers.load(self.LAYER, bytes(pixels), bytes(mask), z=self.Z)
+        else:
+            layers.remove(self.LAYER)
+
+notifier = Notifier()
+animators.append(notifier)
+metrics.gauge("notifications_pending", lambda: len(notifier))
+
+# ----- Presets -----
+
+class Preset:
+    def __init__(self, index: Optional[int], name: str, frame: bytes,
+                 effect: Optional[dict] = None):
+        self.index = index
+        self.name = name
+        self.frame = frame
+        self.effect = effect  # {"effect": name, "speed": .., "hue": .., "saturation": ..}
+
+class PresetStore:
+    """Saved frames (optionally with an effect), recalled by index or name.
+
+    The file is read once by load(); recall() copies the stored frame into
+    the framebuffer and asks for one flush. save() rewrites the whole file
+    atomically (write a temp file, then rename over the old one).
+
+    File format, little-endian: b"RKPS", version (u8), count (u16), then
+    per preset: index (u16, 0xFFFF = none), name length (u8), name (UTF-8),
+    FRAME_SIZE bytes of RGB, effect length (u16), effect JSON (UTF-8).
+    """
+
+    MAGIC = b"RKPS"
+    VERSION = 1
+    NO_INDEX = 0xFFFF
+
+    def __init__(self, path: str = PRESET_FILE):
+        self.path = path
+        self.by_index: dict[int, Preset] = {}
+        self.by_name: dict[str, Preset] = {}
+
+    def __len__(self) -> int:
+        return len({id(p) for p in (*self.by_index.values(), *self.by_name.values())})
+
+    def load(self) -> int:
+        """Read the preset file, replacing what's in memory. Returns the count."""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        self.by_index.clear()
+        self.by_name.clear()
+        for preset in self._decode(data):
+            self._add(preset)
+        return len(self)
+
+    def _decode(self, data: bytes) -> list[Preset]:
+        if data[:4] != self.MAGIC or len(data) < 7:
+            raise ValueError(f"{self.path} is not a preset file")
+        version, count = struct.unpack_from("<BH", data, 4)
+        if version != self.VERSION:
+            raise ValueError(f"Unsupported preset file version {version}")
+        presets = []
+        pos = 7
+        for _ in range(count):
+            index, name_len = struct.unpack_from("<HB", data, pos)
+            pos += 3
+            name = data[pos:pos + name_len].decode("utf-8")
+            pos += name_len
+            frame = data[pos:pos + FRAME_SIZE]
+            pos += FRAME_SIZE
+            (effect_len,) = struct.unpack_from("<H", data, pos)
+            pos += 2
+            effect = json.loads(data[pos:pos + effect_len]) if effect_len else None
+            pos += effect_len
+            if len(frame) != FRAME_SIZE:
+                raise ValueError(f"{self.path} is truncated")
+            presets.append(Preset(None if index == self.NO_INDEX else index, name, frame, effect))
+        return presets
+
+    def _encode(self) -> bytes:
+        presets = list({id(p): p for p in (*self.by_index.values(), *self.by_name.values())}.values())
+        out = [self.MAGIC, struct.pack("<BH", self.VERSION, len(presets))]
+        for p in presets:
+            name = p.name.encode("utf-8")
+            effect = json.dumps(p.effect, separators=(",", ":")).encode() if p.effect else b""
+            out.append(struct.pack("<HB", self.NO_INDEX if p.index is None else p.index, len(name)))
+            out += [name, p.frame, struct.pack("<H", len(effect)), effect]
+        return b"".join(out)
+
+    def _add(self, preset: Preset):
+        # A new preset takes over its index and name from older ones
+        for old in (self.by_index.get(preset.index), self.by_name.get(preset.name)):
+            if old is not None:
+                self.by_index.pop(old.index, None)
+                self.by_name.pop(old.name, None)
+        if preset.index is not None:
+            self.by_index[preset.index] = preset
+        if preset.name:
+            self.by_name[preset.name] = preset
+
+    def get(self, key: Union[int, str]) -> Preset:
+        preset = self.by_index.get(key) if isinstance(key, int) else self.by_name.get(key)
+        if preset is None:
+            raise ValueError(f"No preset {key!r}")
+        return preset
+
+    def save(self, index: Optional[int] = None, name: str = "") -> Preset:
+        """Save the current LEDs (and the running effect) as a preset."""
+        if index is None and not name:
+            raise ValueError("A preset needs an index or a name")
+        if index is not None and not 0 <= index < self.NO_INDEX:
+            raise ValueError(f"Preset index {index} out of range")
+        if len(name.encode("utf-8")) > 255:
+            raise ValueError("Preset name too long")
+        with framebuffer.lock:
+            frame = bytes(framebuffer.pixels)
+        effect = None
+        if effects.active:
+            p = effects.params
+            effect = {"effect": effects.name, "speed": p.speed, "hue": p.hue, "saturation": p.saturation}
+        preset = Preset(index, name, frame, effect)
+        self._add(preset)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self._encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return preset
+
+    def recall(self, key: Union[int, str]):
+        preset = self.get(key)
+        log.debug("Recalling preset %r", key)
+        if preset.effect:
+            params = dict(preset.effect)
+            set_effect(params.pop("effect"), **params)
+            return
+        _stop_animations()
+        with framebuffer.lock:
+            changed = framebuffer.load(preset.frame)
+        if changed:
+            request_flush()
+
+presets = PresetStore()
+
+def _preset_key(payload: str) -> tuple[Optional[int], str]:
+    """Parse a preset/save payload: "3", "movie" or {"index": 3, "name": "movie"}."""
+    if payload.startswith("{"):
+        obj = json.loads(payload)
+        index = obj.get("index")
+        return (None if index is None else int(index)), str(obj.get("name", ""))
+    if payload.isdigit():
+        return int(payload), ""
+    return None, payload
 
 # ----- MQTT glue -----
 
@@ -405,6 +2389,7 @@ def parse_colour(payload: str) -> str:
       - JSON: {"r":255,"g":0,"b":0} or {"h":0,"s":255,"v":255}
       - HSV CSV: "h,s,v"  (0..255)
     Returns a CLI-friendly string: either 'rgb(r,g,b)' or 'h,s,v' or a named colour.
+    The bridge itself parses payloads with parse_colour_rgb().
     """
     p = payload.strip()
 
@@ -445,6 +2430,7 @@ def parse_colour(payload: str) -> str:
     raise ValueError("Unsupported colour format")
 
 # Optional: map keys → (row,col). Populate this as you like.
+# At startup load_keymap() adds the keys it discovers (entries here win).
 # Tip: run `rpi-keyboard-config info --ascii` to see positions, then fill below.
 KEYMAP: dict[str, tuple[int,int]] = {
     # "ESC": (1, 1),
@@ -453,145 +2439,915 @@ KEYMAP: dict[str, tuple[int,int]] = {
     # ... fill to taste
 }
 
-def on_message(client, userdata, msg):
-    topic = msg.topic
-    payload = msg.payload.decode("utf-8").strip()
-
-    # Debug output for incoming messages
-    print(f"[DEBUG] Received message:")
-    print(f"  Topic: {topic}. Payload: '{payload}', length: {len(payload)}")
-   
+# key → LED index, for keys whose position has a known index (see apply_layout)
+KEY_INDEX: dict[str, int] = {}
+
+# ----- Keymap discovery -----
+# A layout is {"model", "variant", "keys": {label: [row, col]},
+# "leds": [[row, col, idx], ...]}. It is discovered once - from the library
+# if it exposes one, else from `rpi-keyboard-config info --ascii` - and
+# cached in KEYMAP_FILE. Neither source has a documented format, so only
+# layouts that map positions to LED indexes are used or cached; anything
+# else is logged and left to KEYMAP.
+
+def _layout_entry(label, value) -> Optional[tuple[str, int, int, Optional[int]]]:
+    """(label, row, col, idx) from one library layout entry, or None."""
+    if isinstance(value, dict):
+        label = value.get("key", value.get("name", value.get("label", label)))
+        rc = value.get("matrix", value.get("rc"))
+        row, col = rc if rc is not None else (value.get("row"), value.get("col"))
+        idx = value.get("idx", value.get("index", value.get("led")))
+    elif isinstance(value, (tuple, list)) and len(value) in (2, 3):
+        row, col, idx = (*value, None)[:3]
+    else:
+        return None
+    if label is None or row is None or col is None:
+        return None
+    return str(label).upper(), int(row), int(col), None if idx is None else int(idx)
+
+def _layout_from_library(keyboard) -> Optional[dict]:
+    # The library has no documented layout API; use one if this version has it
+    for attr in ("get_layout", "layout", "get_keymap", "keymap", "get_led_map", "led_map"):
+        source = getattr(keyboard, attr, None)
+        if source is None:
+            continue
+        try:
+            data = source() if callable(source) else source
+            items = data.items() if isinstance(data, dict) else ((None, v) for v in data)
+            entries = [e for e in (_layout_entry(k, v) for k, v in items) if e is not None]
+        except Exception as e:
+            log.debug("Keyboard %s() not usable as a layout: %s", attr, e)
+            continue
+        if entries:
+            return _layout(entries)
+    return None
+
+# A key label followed by its matrix position and its LED index, e.g.
+# "ESC (0,0) #0", "A [3,1] led 44" or "F1: 0,2 idx=2". The index is required:
+# a bare "word n,m" could be any text in the drawing.
+_ASCII_KEY = re.compile(
+    r"(?P<key>[^\s\[\](),:=|+#]+)\s*[:=]?\s*[(\[]?\s*(?P<row>\d+)\s*,\s*(?P<col>\d+)\s*[)\]]?"
+    r"\s*(?:#|idx|index|led)\s*[:=]?\s*(?P<idx>\d+)", re.IGNORECASE)
+
+def parse_info_ascii(text: str) -> Optional[dict]:
+    """Pull key positions out of `rpi-keyboard-config info --ascii` output.
+
+    The output is a drawing meant for people, so this only looks for label,
+    position and LED index triples anywhere in it and ignores everything else.
+    """
+    entries = [(m.group("key").upper(), int(m.group("row")), int(m.group("col")), int(m.group("idx")))
+               for m in _ASCII_KEY.finditer(text)]
+    return _layout(entries) if entries else None
+
+def _layout(entries) -> dict:
+    return {
+        "keys": {label: [row, col] for label, row, col, _ in entries},
+        "leds": sorted({(row, col, idx) for _, row, col, idx in entries if idx is not None}),
+    }
 
+def _usable_layout(layout: Optional[dict], source: str) -> Optional[dict]:
+    """`layout` if it maps positions to LED indexes, else None (logging what was found)."""
+    if layout is None:
+        return None
+    if not layout["leds"]:
+        log.warning("Ignoring layout from %s: %d key positions but no LED indexes (%s)", source,
+                    len(layout["keys"]), ", ".join(itertools.islice(layout["keys"], 10)))
+        return None
+    log.info("Discovered %d keys and %d LED indexes from %s", len(layout["keys"]), len(layout["leds"]), source)
+    return layout
+
+def discover_layout(keyboard=None) -> Optional[dict]:
+    layout = None
+    if keyboard is not None:
+        layout = _usable_layout(_layout_from_library(keyboard), "the keyboard library")
+    if layout is None:
+        try:
+            layout = _usable_layout(parse_info_ascii(info_ascii()), "rpi-keyboard-config info --ascii")
+        except (OSError, RuntimeError, subprocess.SubprocessError) as e:
+            log.debug("rpi-keyboard-config info unavailable: %s", e)
+    if layout is not None and keyboard is not None:
+        layout["model"] = str(getattr(keyboard, "model", ""))
+        layout["variant"] = str(getattr(keyboard, "variant", ""))
+    return layout
+
+def apply_layout(layout: dict):
+    """Fill KEYMAP, LED_INDEX and KEY_INDEX from a layout."""
+    for label, (row, col) in layout.get("keys", {}).items():
+        KEYMAP.setdefault(label.upper(), (int(row), int(col)))
+    for row, col, idx in layout.get("leds", []):
+        if 0 <= idx < LED_COUNT:
+            LED_INDEX.setdefault((int(row), int(col)), int(idx))
+    KEY_INDEX.clear()
+    KEY_INDEX.update((key, LED_INDEX[rc]) for key, rc in KEYMAP.items() if rc in LED_INDEX)
+
+def load_keymap(path: str = KEYMAP_FILE, keyboard=None) -> int:
+    """Apply the cached layout, discovering (and caching) it if needed.
+
+    A cache made for another keyboard model/variant is rediscovered.
+    Returns the number of keys known afterwards.
+    """
+    layout = None
     try:
-        # Topics:
-        #  - {BASE}/led → set whole keyboard colour
-        #  - {BASE}/led/row,col → set one LED by row,col (e.g., "2,6")
-        #  - {BASE}/led/key/KEY → set one LED by key label using KEYMAP (e.g., "A", "ESC")
-        #  - {BASE}/clear → turn off all LEDs
-        #  - {BASE}/brightness → 0..255
-        #  - {BASE}/hue → 0..255
-        #  - {BASE}/effect → effect name (string); optional JSON {"effect":"Cycle Spiral","speed":140}
-        #  - {BASE}/preset/index → 0..6
-        parts = topic.split("/")
-
-        if topic == f"{BASE}/clear":
-            print(f"[DEBUG] Processing clear command")
-            leds_clear()
-            return
+        with open(path) as f:
+            layout = json.load(f)
+    except FileNotFoundError:
+        pass
+    except ValueError as e:
+        log.warning("Ignoring unreadable keymap cache %s: %s", path, e)
+    if layout is not None and not layout.get("leds"):
+        layout = None  # written by an older version without LED indexes
+    if layout is not None and keyboard is not None and (
+            layout.get("model"), layout.get("variant")) != (
+            str(getattr(keyboard, "model", "")), str(getattr(keyboard, "variant", ""))):
+        layout = None
+    if layout is None:
+        layout = discover_layout(keyboard)
+        if layout is not None:
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(layout, f, indent=1)
+            os.replace(tmp, path)
+    if layout is not None:
+        apply_layout(layout)
+    return len(KEYMAP)
+
+def _batch_position(entry: dict) -> tuple[int, int]:
+    if "key" in entry:
+        key = str(entry["key"]).upper()
+        if key not in KEYMAP:
+            raise ValueError(f"Unknown key '{key}'. Populate KEYMAP or use row,col.")
+        return KEYMAP[key]
+    if "rc" in entry:
+        rc = entry["rc"]
+        if isinstance(rc, str):
+            rc = rc.split(",")
+        row, col = (int(x) for x in rc)
+        return row, col
+    if "row" in entry and "col" in entry:
+        return int(entry["row"]), int(entry["col"])
+    raise ValueError(f"Batch entry needs 'rc', 'row'/'col' or 'key': {entry}")
+
+def parse_batch(payload: str) -> tuple[list[tuple[int, int, Tuple[int, int, int]]], float]:
+    """
+    Parse a {BASE}/led/batch payload into ([(row, col, (r, g, b)), ...], transition).
+    Accept:
+      - JSON list: [{"rc":"2,6","colour":"red"}, {"key":"ESC","colour":"#00FF00"},
+                    {"row":1,"col":3,"colour":{"h":0,"s":255,"v":255}}]
+      - JSON object with a fade: {"transition": 1.5, "leds": [ ...list as above... ]}
+      - CSV, one entry per line or ';'-separated: "2,6,red;ESC,#00FF00;1,3,0,255,255"
+    Colours use the same formats as {BASE}/led. Any bad entry rejects the whole batch.
+    """
+    p = payload.strip()
+    entries = []
+    transition = 0.0
 
-        if topic == f"{BASE}/brightness":
-            print(f"[DEBUG] Processing brightness command: {payload}")
-            set_brightness(int(payload))
-            return
+    if p.startswith("{"):
+        obj = json.loads(p)
+        transition = _transition_seconds(obj.get("transition", 0))
+        p = json.dumps(obj.get("leds", []))
+
+    if p.startswith("["):
+        for entry in json.loads(p):
+            if not isinstance(entry, dict):
+                raise ValueError(f"Batch entry must be an object: {entry}")
+            colour = entry.get("colour", entry.get("color"))
+            if colour is None:
+                raise ValueError(f"Batch entry has no colour: {entry}")
+            if isinstance(colour, dict):
+                colour = json.dumps(colour)
+            entries.append((_batch_position(entry), str(colour)))
+    else:
+        for line in re.split(r"[;\n]", p):
+            fields = [x.strip() for x in line.split(",")]
+            if fields == [""]:
+                continue
+            if len(fields) >= 3 and fields[0].isdigit() and fields[1].isdigit():
+                position = (int(fields[0]), int(fields[1]))
+                colour = ",".join(fields[2:])
+            elif len(fields) >= 2:
+                position = _batch_position({"key": fields[0]})
+                colour = ",".join(fields[1:])
+            else:
+                raise ValueError(f"Bad batch line: '{line}'")
+            entries.append((position, colour))
 
-        if topic == f"{BASE}/hue":
-            print(f"[DEBUG] Processing hue command: {payload}")
-            set_hue(int(payload))
-            return
+    return [(row, col, parse_colour_rgb(colour))
+            for (row, col), colour in entries], transition
 
-        if topic == f"{BASE}/preset/index":
-            print(f"[DEBUG] Processing preset index command: {payload}")
-            set_preset_index(int(payload))
-            return
+def leds_set_batch(payload: str) -> int:
+    """Apply a batch of LED updates atomically with one flush. Returns LEDs changed.
 
-        if topic == f"{BASE}/effect":
-            print(f"[DEBUG] Processing effect command: {payload}")
-            if payload.startswith("{"):
-                obj = json.loads(payload)
-                print(f"[DEBUG] Effect JSON parsed: {obj}")
-                set_effect(
-                    obj.get("effect", ""),
-                    speed=obj.get("speed"),
-                    hue=obj.get("hue"),
-                    saturation=obj.get("saturation"),
-                )
-            else:
-                print(f"[DEBUG] Effect string: {payload}")
-                set_effect(payload)
-            return
+    With a transition the indexed LEDs fade together as one Fade (and count
+    as changed); LEDs only known by position still change at once.
+    """
+    updates, transition = parse_batch(payload)
+    indexed = {}
+    if transition > 0:
+        for row, col, rgb in updates:
+            idx = LED_INDEX.get((row, col))
+            if idx is not None:
+                indexed[idx] = rgb
+        updates = [u for u in updates if (u[0], u[1]) not in LED_INDEX]
+    _stop_animations([LED_INDEX[(row, col)] for row, col, _ in updates if (row, col) in LED_INDEX])
+    with framebuffer.lock:
+        changed = sum(framebuffer.set_rc(row, col, rgb) for row, col, rgb in updates)
+    if indexed:
+        fades.start(list(indexed), b"".join(bytes(rgb) for rgb in indexed.values()), transition)
+        changed += len(indexed)
+    elif changed:
+        request_flush()
+    return changed
+
+# ----- Topic routing -----
+
+def _parse_rc(segment: str) -> tuple[int, int]:
+    row, col = segment.split(",")
+    if not (row.isdigit() and col.isdigit()):
+        raise ValueError(f"Bad row,col '{segment}'")
+    return int(row), int(col)
+
+# Converters for <param> topic segments; a segment that doesn't convert
+# doesn't match. Parameters without a converter are passed as strings.
+ROUTE_PARAMS: dict[str, Callable[[str], object]] = {
+    "rc": _parse_rc,
+    "key": str.upper,
+}
 
-        if topic == f"{BASE}/led":
-            print(f"[DEBUG] Processing LED all command: {payload}")
-            colour = parse_colour(payload)
-            print(f"[DEBUG] Parsed colour: {colour}")
-            leds_set_all(colour)
-            return
+class Router:
+    """Dispatch table from topics (relative to the base topic) to handlers.
+
+    Routes are registered with @router.route("led/key/<key>"). Topics without
+    parameters go in a dict keyed by the full topic, so most messages are a
+    single lookup. Topics with <param> segments go in a trie keyed by
+    segment, so matching costs one step per segment however many routes
+    there are. Handlers are called as handler(payload, *params); payload is
+    the stripped text, or the raw bytes for routes registered with raw=True.
+    `target` says what a route writes, which decides how queued messages
+    coalesce (see Inbox).
+    """
 
-        # /led/<row,col>
-        if len(parts) == 4 and parts[2] == "led" and re.fullmatch(r"\d+,\d+", parts[3]):
-            row, col = (int(x) for x in parts[3].split(","))
-            print(f"[DEBUG] Processing LED row,col command: row={row}, col={col}, payload={payload}")
-            colour = parse_colour(payload)
-            print(f"[DEBUG] Parsed colour: {colour}")
-            led_set_rc(row, col, colour)
+    def __init__(self, base: str):
+        self.base = base
+        self.exact: dict[str, tuple] = {}
+        self.trie: dict = {}
+        self.patterns: list[str] = []
+        self.targets: dict[str, Optional[str]] = {}
+
+    def add(self, pattern: str, handler: Callable, raw: bool = False,
+            target: Optional[str] = None):
+        self.patterns.append(pattern)
+        self.targets[pattern] = target
+        segments = pattern.split("/")
+        if not any(s.startswith("<") for s in segments):
+            self.exact[f"{self.base}/{pattern}"] = (handler, raw, (), pattern)
             return
+        node = self.trie
+        for segment in segments:
+            if segment.startswith("<") and segment.endswith(">"):
+                name = segment[1:-1]
+                key = ("<>", ROUTE_PARAMS.get(name, str))
+            else:
+                key = segment
+            node = node.setdefault(key, {})
+        node[None] = (handler, raw, pattern)
+
+    def route(self, pattern: str, raw: bool = False, target: Optional[str] = None):
+        def register(handler):
+            self.add(pattern, handler, raw, target)
+            return handler
+        return register
+
+    def resolve(self, topic: str):
+        """Return (handler, raw, params, pattern) for a topic, or None if nothing matches."""
+        match = self.exact.get(topic)
+        if match is not None:
+            return match
+        if not topic.startswith(self.base + "/"):
+            return None
+        return self._walk(self.trie, topic[len(self.base) + 1:].split("/"), ())
+
+    def _walk(self, node: dict, segments: list[str], params: tuple):
+        if not segments:
+            leaf = node.get(None)
+            return None if leaf is None else (leaf[0], leaf[1], params, leaf[2])
+        segment, rest = segments[0], segments[1:]
+        child = node.get(segment)
+        if child is not None:
+            match = self._walk(child, rest, params)
+            if match is not None:
+                return match
+        for key, child in node.items():
+            if isinstance(key, tuple):
+                try:
+                    value = key[1](segment)
+                except ValueError:
+                    continue
+                match = self._walk(child, rest, params + (value,))
+                if match is not None:
+                    return match
+        return None
+
+    def subscriptions(self) -> list[str]:
+        """MQTT topic filters covering every route."""
+        filters = []
+        for pattern in self.patterns:
+            topic = "/".join("+" if s.startswith("<") else s for s in pattern.split("/"))
+            filters.append(f"{self.base}/{topic}")
+        return filters
+
+router = Router(BASE)
+
+# Topics:
+#  - {BASE}/led → set whole keyboard colour
+#  - {BASE}/led/row,col → set one LED by row,col (e.g., "2,6")
+#  - {BASE}/led/key/KEY → set one LED by key label using KEYMAP (e.g., "A", "ESC")
+#  - {BASE}/led/batch → set several LEDs at once (see parse_batch)
+#  - {BASE}/clear → turn off all LEDs
+#  - {BASE}/brightness → 0..255
+#  - {BASE}/hue → 0..255
+#  - {BASE}/effect → effect name (string); optional JSON {"effect":"spiral","speed":140}
+#  - {BASE}/preset/index → recall a saved preset by number
+#  - {BASE}/preset/name → recall a saved preset by name
+#  - {BASE}/preset/save → save the current LEDs: "3", "movie" or {"index":3,"name":"movie"}
+#  - {BASE}/frame → 85×3 packed RGB bytes (also /frame/base64, /frame/zlib)
+#  - {BASE}/clip/upload/NAME → store a clip (see parse_clip)
+#  - {BASE}/clip/play → NAME or {"name":"pulse","loop":true}
+#  - {BASE}/clip/stop, {BASE}/clip/delete → stop playback / delete clip NAME
+#  - {BASE}/notify → time-limited overlay (see parse_notification); /notify/cancel → by id
+#  - {BASE}/layer/NAME/led, /led/row,col, /led/key/KEY, /frame → paint a layer
+#  - {BASE}/layer/NAME/mask (85 alpha bytes, or one 0..255 value), /opacity, /z,
+#    /clear, /delete → shape and stack a layer (see Compositor)
+
+@router.route("clear", target="board")
+def _on_clear(payload: str):
+    leds_clear()
+
+@router.route("brightness", target="setting")
+def _on_brightness(payload: str):
+    set_brightness(int(payload))
+
+@router.route("hue", target="setting")
+def _on_hue(payload: str):
+    set_hue(int(payload))
+
+@router.route("preset/index", target="board")
+def _on_preset_index(payload: str):
+    set_preset_index(int(payload))
+
+@router.route("preset/name", target="board")
+def _on_preset_name(payload: str):
+    presets.recall(payload)
+
+@router.route("preset/save")
+def _on_preset_save(payload: str):
+    preset = presets.save(*_preset_key(payload))
+    log.info("Saved preset %s%s", "" if preset.index is None else preset.index,
+             f" '{preset.name}'" if preset.name else "")
+
+@router.route("effect", target="board")
+def _on_effect(payload: str):
+    if payload.startswith("{"):
+        obj = json.loads(payload)
+        set_effect(
+            obj.get("effect", ""),
+            speed=obj.get("speed"),
+            hue=obj.get("hue"),
+            saturation=obj.get("saturation"),
+        )
+    else:
+        set_effect(payload)
+
+@router.route("led", target="board")
+def _on_led(payload: str):
+    leds_set_all(*_split_transition(payload))
+
+@router.route("led/batch", target="leds")
+def _on_led_batch(payload: str):
+    changed = leds_set_batch(payload)
+    log.debug("Batch changed %d LEDs", changed)
+
+@router.route("led/<rc>", target="led")
+def _on_led_rc(payload: str, rc: tuple[int, int]):
+    led_set_rc(rc[0], rc[1], *_split_transition(payload))
+
+@router.route("led/key/<key>", target="led")
+def _on_led_key(payload: str, key: str):
+    colour, transition = _split_transition(payload)
+    idx = KEY_INDEX.get(key)
+    if idx is not None:
+        led_set_index(idx, colour, transition)
+        return
+    if key not in KEYMAP:
+        log.warning("Unknown key '%s'. Populate KEYMAP or use row,col.", key)
+        return
+    row, col = KEYMAP[key]
+    led_set_rc(row, col, colour, transition)
+
+@router.route("frame", raw=True, target="board")
+def _on_frame(payload: bytes):
+    leds_set_frame(payload)
+
+@router.route("frame/<encoding>", raw=True, target="board")
+def _on_frame_encoded(payload: bytes, encoding: str):
+    leds_set_frame(payload, encoding)
+
+def _layer_led(rc: tuple[int, int]) -> int:
+    idx = LED_INDEX.get(rc)
+    if idx is None:
+        raise ValueError(f"No LED index known for {rc[0]},{rc[1]}; layers need one (see KEYMAP_FILE)")
+    return idx
+
+def _key_led(key: str) -> int:
+    key = key.upper()
+    idx = KEY_INDEX.get(key)
+    if idx is not None:
+        return idx
+    if key not in KEYMAP:
+        raise ValueError(f"Unknown key '{key}'. Populate KEYMAP or use row,col.")
+    return _layer_led(KEYMAP[key])
+
+@router.route("layer/<name>/led", target="setting")
+def _on_layer_led(payload: str, name: str):
+    layers.paint(name, list(range(LED_COUNT)), bytes(parse_colour_rgb(payload)) * LED_COUNT)
+
+@router.route("layer/<name>/led/<rc>", target="setting")
+def _on_layer_led_rc(payload: str, name: str, rc: tuple[int, int]):
+    layers.paint(name, [_layer_led(rc)], bytes(parse_colour_rgb(payload)))
+
+@router.route("layer/<name>/led/key/<key>", target="setting")
+def _on_layer_led_key(payload: str, name: str, key: str):
+    layers.paint(name, [_key_led(key)], bytes(parse_colour_rgb(payload)))
+
+@router.route("layer/<name>/frame", raw=True, target="setting")
+def _on_layer_frame(payload: bytes, name: str):
+    layers.paint(name, list(range(LED_COUNT)), bytes(decode_frame(payload)))
+
+@router.route("layer/<name>/mask", raw=True, target="setting")
+def _on_layer_mask(payload: bytes, name: str):
+    if len(payload) == LED_COUNT:
+        layers.set_mask(name, payload)
+    else:
+        layers.set_mask(name, bytes([_clamp(int(payload))]) * LED_COUNT)
 
-        # /led/key/<KEY>
-        if len(parts) == 5 and parts[2] == "led" and parts[3] == "key":
-            key = parts[4].upper()
-            print(f"[DEBUG] Processing LED key command: key={key}, payload={payload}")
-            if key not in KEYMAP:
-                print(f"[DEBUG] Unknown key '{key}'. Populate KEYMAP or use row,col.")
-                return
-            row, col = KEYMAP[key]
-            print(f"[DEBUG] Key '{key}' mapped to row={row}, col={col}")
-            colour = parse_colour(payload)
-            print(f"[DEBUG] Parsed colour: {colour}")
-            led_set_rc(row, col, colour)
-            return
+@router.route("layer/<name>/opacity", target="setting")
+def _on_layer_opacity(payload: str, name: str):
+    layers.set_opacity(name, int(payload))
+
+@router.route("layer/<name>/z", target="setting")
+def _on_layer_z(payload: str, name: str):
+    layers.set_z(name, int(payload))
+
+@router.route("layer/<name>/clear")
+def _on_layer_clear(payload: str, name: str):
+    layers.clear(name)
+
+@router.route("layer/<name>/delete")
+def _on_layer_delete(payload: str, name: str):
+    layers.remove(name)
 
-        print(f"[DEBUG] Unhandled topic: {topic}")
+def parse_notification(payload: str) -> dict:
+    """
+    Parse a {BASE}/notify payload into Notifier.notify() arguments.
+    Accept:
+      - a colour (any {BASE}/led format): the whole keyboard for NOTIFY_TTL seconds
+      - JSON: {"colour":"red", "keys":["ESC","F1"], "priority":5, "ttl":30,
+               "pattern":"blink", "id":"build"}
+        Targets are "keys" (names), "rc" (["row,col", ...]) or "leds" (indexes);
+        none means every LED. pattern is solid (default), blink or pulse.
+    """
+    obj = json.loads(payload) if payload.startswith("{") else None
+    if not isinstance(obj, dict) or ("colour" not in obj and "color" not in obj):
+        return {"leds": list(range(LED_COUNT)), "rgb": parse_colour_rgb(payload)}
+    colour = obj.get("colour", obj.get("color"))
+    leds = [_key_led(str(k)) for k in obj.get("keys", [])]
+    leds += [_layer_led(_parse_rc(str(rc))) for rc in obj.get("rc", [])]
+    for idx in obj.get("leds", []):
+        if not 0 <= int(idx) < LED_COUNT:
+            raise ValueError(f"LED index {idx} out of range 0..{LED_COUNT - 1}")
+        leds.append(int(idx))
+    args = {
+        "leds": leds or list(range(LED_COUNT)),
+        "rgb": parse_colour_rgb(json.dumps(colour) if isinstance(colour, dict) else str(colour)),
+        "priority": int(obj.get("priority", 0)),
+        "ttl": float(obj.get("ttl", NOTIFY_TTL)),
+        "pattern": str(obj.get("pattern", "solid")),
+    }
+    if "id" in obj:
+        args["id"] = str(obj["id"])
+    return args
+
+@router.route("notify")
+def _on_notify(payload: str):
+    id = notifier.notify(**parse_notification(payload))
+    log.debug("Notification %s shown", id)
+
+@router.route("notify/cancel")
+def _on_notify_cancel(payload: str):
+    notifier.cancel(payload)
+
+@router.route("clip/upload/<name>", raw=True)
+def _on_clip_upload(payload: bytes, name: str):
+    clip = clips.add(name, payload)
+    log.info("Stored clip '%s': %d frames, %.2fs%s", name, clip.count, clip.duration,
+             " (mapped from disk)" if clip.path else "")
+
+@router.route("clip/play", target="board")
+def _on_clip_play(payload: str):
+    if payload.startswith("{"):
+        obj = json.loads(payload)
+        player.play(clips.get(str(obj.get("name", ""))), loop=bool(obj.get("loop", False)))
+    else:
+        player.play(clips.get(payload))
+
+@router.route("clip/stop")
+def _on_clip_stop(payload: str):
+    player.stop()
+
+@router.route("clip/delete")
+def _on_clip_delete(payload: str):
+    clips.remove(payload)
+
+# ----- Ingestion -----
+
+class Inbox:
+    """Latest-value-wins queue between the MQTT thread and the renderer.
+
+    A slider sweep can send dozens of messages a second to the same topic;
+    only the newest matters. Messages are keyed by what they write (their
+    route's target), and a new message replaces any pending one with the
+    same key, moving to the back so it still applies after everything that
+    arrived before it:
+      - "board": the whole board (led, clear, frame, effect, preset). One
+        pending at most; it also drops pending "led"/"leds" writes, which it
+        would overwrite anyway. The dropped messages are kept with it and
+        applied after all if it fails (an unknown effect, a missing preset).
+      - "led": one LED per topic (led/<rc>, led/key/<key>), newest per topic.
+      - "setting": a global value (brightness, hue), newest per topic.
+      - "leds": applied in order, never merged (batches each touch different
+        LEDs).
+      - None: applied in order, and nothing queued before it is merged or
+        dropped either (e.g. preset/save, which reads the LEDs as they are).
+    The renderer drains the inbox once per tick, so at most a few hundred
+    entries (one per LED and setting) wait however fast messages arrive.
+    """
 
+    def __init__(self, limit: int = INBOX_LIMIT):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.pending: dict = {}
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def put(self, target: Optional[str], topic: str, item: tuple):
+        with self.lock:
+            pending = self.pending
+            replaced = ()
+            if target == "board":
+                stale = [k for k, (t, _, _) in pending.items() if t in ("board", "led", "leds")]
+                # In arrival order, with what each of them replaced in turn
+                replaced = [old for k in stale for old in (*pending[k][2], pending[k][1])]
+                for k in stale:
+                    del pending[k]
+                if stale:
+                    metrics.inc("messages_coalesced_total", len(stale))
+                key = "board"
+            elif target in ("led", "setting"):
+                key = topic
+                if pending.pop(key, None) is not None:
+                    metrics.inc("messages_coalesced_total")
+            else:
+                if target is None:
+                    # Freeze what came before: re-key it so nothing later
+                    # replaces it or drops it
+                    self.pending = pending = {self._next_key(): (None, item, old)
+                                              for _, item, old in pending.values()}
+                key = self._next_key()
+            if len(pending) >= self.limit:
+                del pending[next(iter(pending))]
+                metrics.inc("messages_dropped_total")
+            pending[key] = (target, item, replaced)
+
+    def _next_key(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def drain(self) -> list[tuple]:
+        """Take every pending (item, replaced) pair, oldest first.
+
+        `replaced` holds the items a "board" message dropped, to apply if
+        it fails; it is empty for everything else.
+        """
+        with self.lock:
+            entries = [(item, replaced) for _, item, replaced in self.pending.values()]
+            self.pending = {}
+        return entries
+
+inbox = Inbox()
+metrics.gauge("inbox_pending", lambda: len(inbox))
+
+def dispatch(handler: Callable, params: tuple, route: str, topic: str, payload) -> bool:
+    """Run a message's handler; returns False if it failed (and was logged)."""
+    start = time.perf_counter()
+    ok = True
+    try:
+        handler(payload, *params)
     except Exception as e:
-        print(f"[DEBUG] Error processing message: {e}")
-        print(f"[DEBUG] Topic: {topic}, Payload: {payload}")
+        ok = False
+        metrics.inc("message_errors_total", route=route)
+        # Raw payloads (frames, clips) can be megabytes: log their size only
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            shown = f"{len(payload)} bytes"
+        else:
+            shown = repr(payload[:LOG_PAYLOAD_CHARS]) + ("..." if len(payload) > LOG_PAYLOAD_CHARS else "")
+        log.warning("Error processing %s (payload %s): %s", topic, shown, e)
+    metrics.inc("messages_total", route=route)
+    metrics.observe("message_seconds", time.perf_counter() - start, route=route)
+    return ok
+
+def dispatch_pending():
+    """Apply everything queued in the inbox (on the renderer, once per tick)."""
+    for item, replaced in inbox.drain():
+        if not dispatch(*item):
+            # A failed whole-board write overwrites nothing: apply what it replaced
+            for old in replaced:
+                dispatch(*old)
+
+def on_message(client, userdata, msg):
+    topic = msg.topic
+    match = router.resolve(topic)
+    if match is None:
+        metrics.inc("messages_unhandled_total")
+        log.debug("Unhandled topic: %s", topic)
+        return
+    handler, raw, params, route = match
+
+    # Binary routes (e.g. frames) get the payload as sent
+    payload = msg.payload if raw else msg.payload.decode("utf-8").strip()
+
+    if raw:
+        log.debug("Received %s: %d bytes", topic, len(payload))
+    else:
+        log.debug("Received %s: %r", topic, payload)
+
+    item = (handler, params, route, topic, payload)
+    if renderer is not None and renderer.is_alive():
+        # Applied by the renderer on its next tick, newest value per target
+        inbox.put(router.targets[route], topic, item)
+        renderer.request()
+    else:
+        dispatch(*item)
 
 def on_connect(client, userdata, flags, rc):
-    print(f"[DEBUG] Connected to MQTT broker with result code {rc}")
     if rc == 0:
-        print(f"[DEBUG] Successfully connected to {MQTT_HOST}:{MQTT_PORT}")
+        log.info("Connected to MQTT broker at %s:%d", MQTT_HOST, MQTT_PORT)
     else:
-        print(f"[DEBUG] Failed to connect to MQTT broker, result code {rc}")
+        log.error("Failed to connect to MQTT broker, result code %s", rc)
+
+# ----- Streaming input -----
+# For live animations the broker round trip adds visible jitter, so frames
+# can also be sent as datagrams straight to the bridge (UDP or a Unix
+# socket). A packet is a 4-byte big-endian sequence number followed by a
+# {BASE}/frame payload (FRAME_SIZE bytes of packed RGB), or just the frame.
+
+class StreamReceiver:
+    """Apply streamed frames, dropping packets that arrive out of order.
+
+    Sequence numbers are compared per sender with wrap-around (serial number)
+    arithmetic, so a packet older than the newest one seen is discarded.
+    After STREAM_TIMEOUT seconds without packets a sender may start again
+    from any number. Frames go straight into the framebuffer and share the
+    render loop's flush with MQTT.
+    """
 
-def main():
+    def __init__(self, timeout: float = STREAM_TIMEOUT):
+        self.timeout = timeout
+        self.senders: dict = {}  # address → (last sequence, time seen)
+
+    def feed(self, packet: bytes, sender=None) -> bool:
+        """Apply one packet. Returns False if it was late or malformed."""
+        if len(packet) == FRAME_SIZE + 4:
+            (seq,) = struct.unpack_from("!I", packet)
+            now = time.monotonic()
+            last = self.senders.get(sender)
+            if last is not None and now - last[1] < self.timeout and not 0 < (seq - last[0]) % 2**32 < 2**31:
+                metrics.inc("stream_late_total")
+                return False
+            self.senders[sender] = (seq, now)
+            frame = memoryview(packet)[4:]
+        elif len(packet) == FRAME_SIZE:
+            frame = memoryview(packet)
+        else:
+            metrics.inc("stream_bad_total")
+            log.warning("Stream packet of %d bytes ignored (want %d or %d)",
+                        len(packet), FRAME_SIZE, FRAME_SIZE + 4)
+            return False
+        metrics.inc("stream_frames_total")
+        _stop_animations()
+        with framebuffer.lock:
+            changed = framebuffer.load(frame)
+        if changed:
+            request_flush()
+        return True
+
+stream = StreamReceiver()
+
+def serve_stream(address, family: int = socket.AF_INET) -> socket.socket:
+    """Receive stream packets on a datagram socket from a daemon thread.
+
+    address is (host, port) for UDP, or a filesystem path with AF_UNIX.
+    """
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if family == socket.AF_UNIX:
+        try:
+            os.unlink(address)
+        except FileNotFoundError:
+            pass
+    sock.bind(address)
+
+    def receive():
+        while True:
+            try:
+                packet, sender = sock.recvfrom(FRAME_SIZE + 64)
+            except OSError:
+                return  # socket closed
+            try:
+                stream.feed(packet, sender)
+            except Exception as e:
+                log.error("Stream frame failed: %s", e)
+
+    threading.Thread(target=receive, name="stream", daemon=True).start()
+    return sock
+
+def _start_streams():
+    if STREAM_UDP_PORT:
+        serve_stream(("", STREAM_UDP_PORT))
+        log.info("Accepting streamed frames on UDP port %d", STREAM_UDP_PORT)
+    if STREAM_SOCKET:
+        serve_stream(STREAM_SOCKET, socket.AF_UNIX)
+        log.info("Accepting streamed frames on %s", STREAM_SOCKET)
+
+def _check_keyboard():
     # Check if we have proper permissions
-    print(f"[DEBUG] Running as user: {os.getuid()}")
+    log.info("Running as user: %d", os.getuid())
+    log.info("LED backend: %s", backend.name)
 
-    # Test keyboard access at startup
-    print(f"[DEBUG] Testing keyboard access at startup...")
-    try:
-        keyboard.set_led_direct_effect()
-        print(f"[DEBUG] Keyboard access test: SUCCESS")
-    except Exception as e:
-        print(f"[DEBUG] Keyboard access test: FAILED - {e}")
-        print(f"[DEBUG] Try running with: sudo python3 rpi_mqtt.py")
+    # Open the keyboard now rather than on the first message
+    if isinstance(backend, LibraryBackend):
+        try:
+            device.open().set_led_direct_effect()
+            log.info("Keyboard access test: SUCCESS")
+        except Exception as e:
+            log.error("Keyboard access test: FAILED - %s", e)
+            log.error("Try running with: sudo python3 rpi_mqtt.py")
+
+def run_threaded():
+    # Imported here so tests and benchmarks can import this module without
+    # paying for the MQTT client
+    import paho.mqtt.client as mqtt
+
+    global renderer
+    renderer = Renderer(MAX_FPS)
+    renderer.start()
+    _start_streams()
 
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
 
-    print(f"[DEBUG] Attempting to connect to MQTT broker at {MQTT_HOST}:{MQTT_PORT}")
+    log.info("Connecting to MQTT broker at %s:%d", MQTT_HOST, MQTT_PORT)
     try:
         client.connect(MQTT_HOST, MQTT_PORT, 60)
     except Exception as e:
-        print(f"[DEBUG] Connection error: {e}")
+        log.error("Connection error: %s", e)
+        renderer.stop()
         return
 
     # Subscriptions
-    subs = [
-        f"{BASE}/led",
-        f"{BASE}/led/#",
-        f"{BASE}/clear",
-        f"{BASE}/brightness",
-        f"{BASE}/hue",
-        f"{BASE}/effect",
-        f"{BASE}/preset/index",
-    ]
-    for t in subs:
+    for t in router.subscriptions():
         client.subscribe(t)
 
-    print("Connected. Try publishing to topics under:", BASE)
-    client.loop_forever()
+    if STATS_INTERVAL:
+        animators.append(StatsPublisher(client, STATS_INTERVAL))
+        renderer.request()
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+        log.info("Serving metrics on port %d", METRICS_PORT)
+
+    log.info("Listening. Try publishing to topics under: %s", BASE)
+    try:
+        client.loop_forever()
+    finally:
+        renderer.stop()
+
+async def run_asyncio():
+    """Run the bridge on an asyncio event loop (RUNTIME = "asyncio").
+
+    paho does its socket I/O from the loop's reader/writer callbacks, and a
+    housekeeping task drives keepalives and reconnects. The blocking parts,
+    the TCP connect and keyboard writes, run on executors, so a broker outage
+    or a slow keyboard doesn't stall the other tasks.
+    """
+    import paho.mqtt.client as mqtt
+
+    loop = asyncio.get_running_loop()
+    loop_thread = threading.get_ident()
+
+    def on_loop(fn, *args):
+        # paho calls the socket hooks from whichever thread touched the
+        # socket; the event loop may only be changed from its own thread
+        if threading.get_ident() == loop_thread:
+            fn(*args)
+        else:
+            loop.call_soon_threadsafe(fn, *args)
+
+    def on_connect_subscribe(client, userdata, flags, rc):
+        on_connect(client, userdata, flags, rc)
+        if rc == 0:
+            # Subscribe on every connect: a clean session forgets them
+            for t in router.subscriptions():
+                client.subscribe(t)
+
+    global renderer
+    renderer = AsyncRenderer(MAX_FPS)
+    renderer.start()
+    _start_streams()
+
+    client = mqtt.Client()
+    client.on_connect = on_connect_subscribe
+    client.on_message = on_message
+    client.on_socket_open = lambda c, u, sock: on_loop(loop.add_reader, sock, c.loop_read)
+    client.on_socket_close = lambda c, u, sock: on_loop(loop.remove_reader, sock)
+    client.on_socket_register_write = lambda c, u, sock: on_loop(loop.add_writer, sock, c.loop_write)
+    client.on_socket_unregister_write = lambda c, u, sock: on_loop(loop.remove_writer, sock)
+
+    log.info("Connecting to MQTT broker at %s:%d", MQTT_HOST, MQTT_PORT)
+    try:
+        await loop.run_in_executor(None, client.connect, MQTT_HOST, MQTT_PORT, 60)
+    except Exception as e:
+        log.error("Connection error: %s", e)
+        await renderer.stop()
+        return
+
+    async def housekeeping():
+        delay = 1.0
+        while True:
+            if client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    await loop.run_in_executor(None, client.reconnect)
+                    delay = 1.0
+                except Exception as e:
+                    log.warning("MQTT reconnect failed, retrying in %.0fs: %s", delay, e)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                    continue
+            await asyncio.sleep(1)
+
+    mqtt_task = loop.create_task(housekeeping(), name="mqtt")
+
+    if STATS_INTERVAL:
+        animators.append(StatsPublisher(client, STATS_INTERVAL))
+        renderer.request()
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+        log.info("Serving metrics on port %d", METRICS_PORT)
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    log.info("Listening. Try publishing to topics under: %s", BASE)
+    try:
+        await stop.wait()
+    finally:
+        mqtt_task.cancel()
+        client.disconnect()
+        await renderer.stop()
+
+def main():
+    log_listener = setup_logging(LOG_LEVEL)
+    try:
+        _check_keyboard()
+        try:
+            keyboard = device.open() if isinstance(backend, LibraryBackend) else None
+        except Exception:
+            keyboard = None
+        try:
+            log.info("Keymap: %d keys, %d with LED indexes", load_keymap(keyboard=keyboard), len(KEY_INDEX))
+        except Exception as e:
+            log.error("Keymap discovery failed: %s", e)
+        try:
+            log.info("Loaded %d presets from %s", presets.load(), presets.path)
+        except Exception as e:
+            log.error("Could not load presets from %s: %s", presets.path, e)
+        log.info("Loaded %d clips from %s", clips.load(), clips.directory)
+        if RUNTIME == "asyncio":
+            asyncio.run(run_asyncio())
+        else:
+            run_threaded()
+    finally:
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
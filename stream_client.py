@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Stream frames to the bridge's UDP / Unix datagram input.
+
+Stands in for a PC driving live animations: sends a scrolling rainbow as
+sequence-numbered frames (see "Streaming input" in rpi_mqtt.py).
+
+    python3 stream_client.py --host 192.168.1.50 --port 21324 --fps 60
+    python3 stream_client.py --unix /run/rpi_mqtt.sock --seconds 5
+    python3 stream_client.py --port 21324 --reorder 10   # every 10th pair swapped
+"""
+
+import argparse
+import colorsys
+import socket
+import struct
+import sys
+import time
+
+LED_COUNT = 85
+
+def rainbow(t: float) -> bytes:
+    frame = bytearray()
+    for i in range(LED_COUNT):
+        r, g, b = colorsys.hsv_to_rgb((i / LED_COUNT + t) % 1.0, 1.0, 1.0)
+        frame += bytes((int(r * 255), int(g * 255), int(b * 255)))
+    return bytes(frame)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=21324)
+    parser.add_argument("--unix", help="Unix datagram socket path (instead of UDP)")
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--seconds", type=float, default=10, help="how long to stream (0 = forever)")
+    parser.add_argument("--speed", type=float, default=0.25, help="rainbow turns per second")
+    parser.add_argument("--reorder", type=int, default=0,
+                        help="swap every Nth pair of packets, to check late ones are dropped")
+    parser.add_argument("--no-seq", action="store_true", help="send bare frames without sequence numbers")
+    args = parser.parse_args(argv)
+
+    if args.unix:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        address = args.unix
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        address = (args.host, args.port)
+
+    interval = 1.0 / args.fps
+    start = time.monotonic()
+    seq = 0
+    held = None
+    try:
+        while not args.seconds or time.monotonic() - start < args.seconds:
+            frame = rainbow((time.monotonic() - start) * args.speed)
+            packet = frame if args.no_seq else struct.pack("!I", seq & 0xFFFFFFFF) + frame
+            seq += 1
+            if args.reorder and seq % args.reorder == 0:
+                held = packet  # send after the next one: it arrives late
+            else:
+                sock.sendto(packet, address)
+                if held is not None:
+                    sock.sendto(held, address)
+                    held = None
+            time.sleep(max(0.0, start + seq * interval - time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+    print(f"Sent {seq} frames in {time.monotonic() - start:.1f}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
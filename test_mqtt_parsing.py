@@ -29,9 +29,9 @@ class MockKeyboard:
     def send_leds(self):
         print("Mock: Send LEDs")
 
-# Replace the real keyboard with mock
+# Use the mock in place of the real keyboard (importing rpi_mqtt doesn't open it)
 import rpi_mqtt
-rpi_mqtt.keyboard = MockKeyboard()
+rpi_mqtt.device.factory = MockKeyboard
 
 # Import functions to test
 from rpi_mqtt import parse_colour, _parse_colour_to_rgb, on_message, BASE
@@ -96,6 +96,38 @@ def test_mqtt_messages():
         except Exception as e:
             print(f"✗ Error processing message: {e}")
 
+def test_router():
+    """Test topic → handler dispatch"""
+    print("\n=== Testing Topic Router ===")
+    from rpi_mqtt import Router
+
+    calls = []
+    router = Router("base")
+    router.add("led", lambda p: calls.append(("all", p)))
+    router.add("led/batch", lambda p: calls.append(("batch", p)))
+    router.add("led/<rc>", lambda p, rc: calls.append(("rc", rc)))
+    router.add("led/key/<key>", lambda p, key: calls.append(("key", key)))
+    router.add("frame/<encoding>", lambda p, enc: calls.append(("frame", enc)), raw=True)
+
+    cases = [
+        ("base/led", ("all", "x")),
+        ("base/led/batch", ("batch", "x")),
+        ("base/led/2,6", ("rc", (2, 6))),
+        ("base/led/key/esc", ("key", "ESC")),
+        ("base/frame/zlib", ("frame", "zlib")),
+    ]
+    for topic, expected in cases:
+        handler, raw, params, pattern = router.resolve(topic)
+        handler("x", *params)
+        assert calls[-1] == expected, f"{topic}: {calls[-1]} != {expected}"
+        print(f"✓ {topic:20} -> {expected}")
+
+    for topic in ("base/led/a,b", "base/led/key", "base/other", "elsewhere/led"):
+        assert router.resolve(topic) is None, f"{topic} should not match"
+        print(f"✓ {topic:20} -> unhandled")
+
+    assert "base/led/key/+" in router.subscriptions()
+
 def main():
     """Run all tests"""
     print("=== Testing rpi_mqtt.py MQTT Functionality ===\n")
@@ -103,6 +135,7 @@ def main():
     try:
         test_color_parsing()
         test_mqtt_messages()
+        test_router()
         print("\n=== All tests completed! ===")
         print("\nThe app successfully:")
         print("- Parses various color formats (named, hex, RGB, HSV, JSON)")
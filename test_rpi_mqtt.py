@@ -3,12 +3,21 @@
 
 import sys
 import os
+from types import SimpleNamespace
 
 # Add system path for RPiKeyboardConfig
 sys.path.insert(0, '/usr/lib/python3/dist-packages')
 
 # Import the functions we want to test
-from rpi_mqtt import parse_colour, _parse_colour_to_rgb, leds_clear, leds_set_all, led_set_rc
+from rpi_mqtt import parse_colour, parse_colour_rgb, _parse_colour_to_rgb, leds_clear, leds_set_all, led_set_rc
+
+def mock_backend():
+    """Switch to the mock backend with brightness and hue neutral; returns it."""
+    import rpi_mqtt
+    backend = rpi_mqtt.use_backend("mock")
+    rpi_mqtt.set_brightness(255)
+    rpi_mqtt.set_hue(0)
+    return backend
 
 def test_color_parsing():
     """Test various color parsing functions"""
@@ -16,15 +25,19 @@ def test_color_parsing():
 
     # Test named colors
     assert parse_colour("red") == "red"
-    assert _parse_colour_to_rgb("red") == (255, 0, 0)
+    assert parse_colour_rgb("red") == (255, 0, 0)
+    # The keyboard gets BGR scaled to its 0..32 levels
+    assert _parse_colour_to_rgb("red") == (0, 0, 32)
 
     # Test hex colors
     assert parse_colour("#FF0000") == "rgb(255,0,0)"
-    assert _parse_colour_to_rgb("#FF0000") == (255, 0, 0)
+    assert parse_colour_rgb("#FF0000") == (255, 0, 0)
+    assert _parse_colour_to_rgb("#FF0000") == (0, 0, 32)
 
-    # Test CSV colors
+    # Test CSV colors (h,s,v)
     assert parse_colour("255,0,0") == "255,0,0"
-    assert _parse_colour_to_rgb("255,0,0") == (255, 0, 0)
+    assert parse_colour_rgb("0,255,255") == (255, 0, 0)
+    assert _parse_colour_to_rgb("0,255,255") == (0, 0, 32)
 
     # Test JSON colors
     assert parse_colour('{"r":255,"g":0,"b":0}') == "rgb(255,0,0)"
@@ -32,24 +45,908 @@ def test_color_parsing():
 
     print("✓ Color parsing tests passed")
 
+def test_parse_colour_rgb():
+    """Test the unified (cached) colour parser"""
+    print("Testing parse_colour_rgb...")
+
+    assert parse_colour_rgb("red") == (255, 0, 0)
+    assert parse_colour_rgb("#00FF00") == (0, 255, 0)
+    assert parse_colour_rgb("rgb(1,2,3)") == (1, 2, 3)
+    assert parse_colour_rgb('{"r":300,"g":0,"b":0}') == (255, 0, 0)
+    assert parse_colour_rgb('{"h":0,"s":255,"v":255}') == (255, 0, 0)
+    assert parse_colour_rgb("0,0,128") == (128, 128, 128)
+
+    # Everything parse_colour() returns parses to the same colour
+    for payload in ("#FF8000", '{"h":40,"s":200,"v":255}', "blue"):
+        assert parse_colour_rgb(parse_colour(payload)) == parse_colour_rgb(payload)
+
+    for bad in ("notacolour", "#GGGGGG", "1,2", '{"x":1}'):
+        try:
+            parse_colour_rgb(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"{bad!r} should not parse")
+
+    # Keyboard levels are scaled to 0..32 and never round a lit channel to 0
+    assert _parse_colour_to_rgb("#FF0101") == (1, 1, 32)
+
+    print("✓ parse_colour_rgb tests passed")
+
+def test_postprocess():
+    """Test brightness and hue lookup tables"""
+    print("Testing PostProcess...")
+    from rpi_mqtt import PostProcess
+
+    post = PostProcess()
+    assert not post.active
+    assert post.apply(bytes([255, 100, 1])) == bytes([255, 100, 1])
+
+    post.set_brightness(128)
+    assert post.apply_rgb((255, 100, 0)) == (128, 50, 0)
+
+    post.set_brightness(255)
+    post.set_hue(85)  # a third of a turn: red → green
+    r, g, b = post.apply_rgb((255, 0, 0))
+    assert g == 255 and r <= 2 and b <= 2
+    assert post.apply_rgb((255, 255, 255)) == (255, 255, 255)
+
+    print("✓ PostProcess tests passed")
+
+def test_effects():
+    """Test that every registered effect renders a full frame"""
+    print("Testing effects...")
+    from rpi_mqtt import EFFECTS, EFFECT_FPS, EffectEngine, FRAME_SIZE, list_effects
+
+    engine = EffectEngine()
+    for name in EFFECTS:
+        assert name in list_effects()
+        engine.start(name, speed=200, hue=30)
+        frames = {engine.render(t / 10) for t in range(10)}
+        assert all(len(frame) == FRAME_SIZE for frame in frames)
+        # The system-metrics effects (rate capped) follow load, not time
+        if name != "solid" and name not in EFFECT_FPS:
+            assert len(frames) > 1, f"{name} does not animate"
+    engine.stop()
+    assert engine.next_due(0.0) is None
+
+    print("✓ Effect tests passed")
+
+def test_device_reconnect():
+    """Test that a lost keyboard is reopened with backoff and replayed"""
+    print("Testing DeviceManager reconnect...")
+    import time
+    from rpi_mqtt import DeviceManager, DeviceUnavailable
+
+    opened = []
+    manager = DeviceManager(lambda: opened.append(object()) or opened[-1], min_delay=0, max_delay=0)
+    replays = []
+    manager.on_reconnect.append(lambda: replays.append(True))
+
+    first = manager.open()
+    assert manager.open() is first and len(opened) == 1 and not replays
+
+    manager.lost(OSError("unplugged"))
+    assert not manager.connected and manager.next_due(0.0) is not None
+    assert manager.open() is not first and replays == [True]
+
+    def broken():
+        raise OSError("no keyboard")
+    manager = DeviceManager(broken, min_delay=60)
+    for expected in (OSError, DeviceUnavailable):
+        try:
+            manager.open()
+        except expected:
+            continue
+        raise AssertionError(f"expected {expected.__name__}")
+    # Never opened yet: the render loop still wakes up for the retry
+    assert manager.failures == 1 and 0 < manager.next_due(time.monotonic()) <= 60
+    assert DeviceManager(broken).next_due(0.0) is None, "nothing to retry before the first open"
+
+    # The retry happens in step(), so the loop sleeps between attempts instead of spinning
+    import asyncio
+    import rpi_mqtt
+    attempts = []
+    def missing():
+        attempts.append(time.monotonic())
+        raise OSError("no keyboard")
+    manager = DeviceManager(missing, min_delay=0.05, max_delay=0.1)
+    try:
+        manager.open()
+    except OSError:
+        pass
+
+    async def idle():
+        rpi_mqtt.renderer = rpi_mqtt.AsyncRenderer(fps=100)
+        rpi_mqtt.renderer.start()
+        try:
+            cpu = time.process_time()
+            await asyncio.sleep(0.5)
+            return time.process_time() - cpu
+        finally:
+            await rpi_mqtt.renderer.stop()
+            rpi_mqtt.renderer = None
+
+    saved = rpi_mqtt.animators[:]
+    rpi_mqtt.animators[:] = [manager]
+    try:
+        cpu = asyncio.run(idle())
+    finally:
+        rpi_mqtt.animators[:] = saved
+    assert 3 <= len(attempts) <= 10, len(attempts)
+    assert cpu < 0.25, f"loop spun: {cpu:.2f}s CPU in 0.5s"
+
+    print("✓ DeviceManager tests passed")
+
+def test_log_rate_limit():
+    """Test that repeated log lines are sampled"""
+    print("Testing RateLimitFilter...")
+    import logging
+    from rpi_mqtt import RateLimitFilter
+
+    limiter = RateLimitFilter(burst=3, interval=10)
+
+    def record(msg, created):
+        rec = logging.LogRecord("rpi_mqtt", logging.DEBUG, __file__, 0, msg, (1,), None)
+        rec.created = created
+        return rec
+
+    passed = [limiter.filter(record("flood %d", 100 + i / 10)) for i in range(10)]
+    assert passed == [True] * 3 + [False] * 7
+    assert limiter.filter(record("other %d", 101))
+
+    # The next window reports what was dropped
+    rec = record("flood %d", 120)
+    assert limiter.filter(rec) and "7 similar messages suppressed" in rec.msg
+
+    print("✓ RateLimitFilter tests passed")
+
+def test_metrics():
+    """Test counters, histograms and both export formats"""
+    print("Testing Metrics...")
+    from rpi_mqtt import Metrics
+
+    m = Metrics()
+    m.inc("messages_total", route="led")
+    m.inc("messages_total", 2, route="led")
+    for ms in (0.2, 0.3, 40):
+        m.observe("message_seconds", ms / 1000, route="led")
+    m.gauge("pending_leds", lambda: 7)
+
+    snap = m.snapshot()
+    assert snap["counters"]["messages_total{route=led}"] == 3
+    latency = snap["latency"]["message_seconds{route=led}"]
+    assert latency["count"] == 3 and latency["p50_ms"] <= 0.5 and latency["max_ms"] == 40
+    assert snap["gauges"]["pending_leds"] == 7
+
+    text = m.prometheus()
+    assert 'rpi_mqtt_messages_total{route="led"} 3' in text
+    assert 'rpi_mqtt_message_seconds_bucket{route="led",le="+Inf"} 3' in text
+    assert "rpi_mqtt_pending_leds 7" in text
+
+    print("✓ Metrics tests passed")
+
+def test_inbox():
+    """Test latest-value-wins coalescing of queued messages"""
+    print("Testing Inbox...")
+    import logging
+    import rpi_mqtt
+    from rpi_mqtt import Inbox, LOG_PAYLOAD_CHARS, dispatch
+
+    inbox = Inbox(limit=4)
+
+    def drain():
+        return [item for item, _ in inbox.drain()]
+
+    for v in range(50):
+        inbox.put("setting", "kb/brightness", ("brightness", v))
+    inbox.put("led", "kb/led/1,1", ("1,1", "red"))
+    inbox.put("leds", "kb/led/batch", ("batch", 1))
+    inbox.put("leds", "kb/led/batch", ("batch", 2))
+    assert len(inbox) == 4
+    assert drain() == [("brightness", 49), ("1,1", "red"), ("batch", 1), ("batch", 2)]
+    assert len(inbox) == 0
+
+    # A whole-board write drops the LED writes before it, not the ones after
+    inbox.put("led", "kb/led/1,1", ("1,1", "red"))
+    inbox.put("setting", "kb/hue", ("hue", 10))
+    inbox.put("board", "kb/led", ("led", "blue"))
+    inbox.put("led", "kb/led/2,2", ("2,2", "green"))
+    inbox.put("board", "kb/clear", ("clear", ""))
+    inbox.put("led", "kb/led/2,2", ("2,2", "white"))
+    assert drain() == [("hue", 10), ("clear", ""), ("2,2", "white")]
+
+    # Nothing queued before an ordered (None) message is merged or dropped
+    inbox.put("led", "kb/led/1,1", ("1,1", "red"))
+    inbox.put(None, "kb/preset/save", ("save", "1"))
+    inbox.put("led", "kb/led/1,1", ("1,1", "blue"))
+    inbox.put("board", "kb/clear", ("clear", ""))
+    assert drain() == [("1,1", "red"), ("save", "1"), ("clear", "")]
+
+    # Past the limit the oldest pending message is dropped
+    for v in range(6):
+        inbox.put(None, "kb/other", ("other", v))
+    assert drain() == [("other", v) for v in range(2, 6)]
+
+    # A board message keeps what it dropped, in order, in case it fails
+    inbox.put("led", "kb/led/1,1", ("1,1", "red"))
+    inbox.put("board", "kb/led", ("led", "blue"))
+    inbox.put("leds", "kb/led/batch", ("batch", 1))
+    inbox.put("board", "kb/effect", ("effect", "nope"))
+    assert inbox.drain() == [(("effect", "nope"), [("1,1", "red"), ("led", "blue"), ("batch", 1)])]
+
+    # ... and applies it if it does fail
+    mock = mock_backend()
+    leds_set_all("black")
+    saved, rpi_mqtt.inbox = rpi_mqtt.inbox, Inbox()
+    try:
+        def put(target, topic, payload):
+            handler, raw, params, route = rpi_mqtt.router.resolve(f"{rpi_mqtt.BASE}/{topic}")
+            rpi_mqtt.inbox.put(target, topic, (handler, params, route, topic, payload))
+        put("led", "led/1,1", "#0000FF")
+        put("leds", "led/batch", "2,2,#00FF00")
+        put("board", "effect", "Cycle Spiral")
+        rpi_mqtt.dispatch_pending()
+        rpi_mqtt.flush()
+        assert mock.matrix[(1, 1)] == (0, 0, 255) and mock.matrix[(2, 2)] == (0, 255, 0)
+        assert not rpi_mqtt.effects.active
+    finally:
+        rpi_mqtt.inbox = saved
+
+    # A failed message is logged with its size (raw) or a short excerpt, not in full
+    lines = []
+    handler = logging.Handler()
+    handler.emit = lambda record: lines.append(record.getMessage())
+    rpi_mqtt.log.addHandler(handler)
+    try:
+        def fail(payload):
+            raise ValueError("bad")
+        dispatch(fail, (), "clip/upload/<name>", "kb/clip/upload/big", bytes(1 << 20))
+        dispatch(fail, (), "led/batch", "kb/led/batch", "x" * 10000)
+    finally:
+        rpi_mqtt.log.removeHandler(handler)
+    assert "(payload 1048576 bytes)" in lines[0]
+    assert len(lines[1]) < LOG_PAYLOAD_CHARS + 100 and "..." in lines[1]
+
+    print("✓ Inbox tests passed")
+
 def test_led_functions():
     """Test LED control functions"""
     print("Testing LED control functions...")
+    import rpi_mqtt
+
+    # Record LED writes instead of driving a keyboard
+    mock = mock_backend()
+
+    print("Testing leds_clear()...")
+    leds_clear()
+    assert mock.frame == bytes(rpi_mqtt.FRAME_SIZE)
+
+    print("Testing leds_set_all()...")
+    leds_set_all("red")
+    assert mock.frame == bytes([255, 0, 0]) * rpi_mqtt.LED_COUNT
+
+    print("Testing led_set_rc()...")
+    writes = mock.writes
+    led_set_rc(1, 1, "blue")
+    assert mock.matrix[(1, 1)] == (0, 0, 255)
+    assert mock.writes == writes + 1
+
+    # Same colour again: nothing to send
+    led_set_rc(1, 1, "blue")
+    assert mock.writes == writes + 1
+
+    print("✓ LED control tests completed")
+
+def test_frames():
+    """Test {BASE}/frame: raw, base64 and zlib encodings, length checks, dirty LEDs"""
+    print("Testing frames...")
+    import base64
+    import zlib
+    import rpi_mqtt
+    from rpi_mqtt import BASE, FRAME_SIZE, LED_COUNT, decode_frame, framebuffer
+
+    mock = mock_backend()
+    leds_clear()
+
+    def publish(topic, payload):
+        rpi_mqtt.on_message(None, None, SimpleNamespace(topic=f"{BASE}/{topic}", payload=payload))
+
+    frame = bytes(range(FRAME_SIZE))
+    publish("frame", frame)
+    assert mock.frame == frame
+
+    # Only the LEDs that differ are sent
+    second = bytearray(frame)
+    second[6:9] = b"\xff\xff\xff"
+    publish("frame/base64", base64.b64encode(second))
+    assert mock.frame == second and [idx for idx, _ in mock.commits[-1][0]] == [2]
 
-    # These will use the mock keyboard
+    third = bytes([7]) * FRAME_SIZE
+    publish("frame/zlib", zlib.compress(third))
+    assert mock.frame == third
+    with framebuffer.lock:
+        assert framebuffer.load(third) == 0, "an identical frame changes nothing"
+
+    # Rejected: wrong length, inflating past a frame, bad base64, unknown encoding
+    writes = mock.writes
+    for topic, payload in (("frame", third[:-1]), ("frame", third + b"\0"),
+                           ("frame/zlib", zlib.compress(bytes(FRAME_SIZE * 1000))),
+                           ("frame/base64", b"not base64!"), ("frame/gzip", third)):
+        publish(topic, payload)
+        assert mock.writes == writes and mock.frame == third, topic
+    try:
+        decode_frame(zlib.compress(bytes(FRAME_SIZE * 1000)), "zlib")
+        assert False, "Expected ValueError"
+    except ValueError as e:
+        assert str(FRAME_SIZE + 1) in str(e), "zlib output is bounded to one frame"
+    assert len(decode_frame(zlib.compress(bytes(FRAME_SIZE)), "zlib")) == LED_COUNT * 3
+
+    print("✓ Frame tests passed")
+
+def test_led_batch():
+    """Test {BASE}/led/batch: JSON and CSV forms, one commit, all-or-nothing"""
+    print("Testing LED batches...")
+    import json
+    import rpi_mqtt
+    from rpi_mqtt import parse_batch, leds_set_batch
+
+    mock = mock_backend()
+    saved = dict(rpi_mqtt.KEYMAP)
+    rpi_mqtt.KEYMAP["ESC"] = (0, 0)
     try:
-        print("Testing leds_clear()...")
+        red, green = (255, 0, 0), (0, 255, 0)
+        assert parse_batch(json.dumps([
+            {"rc": "2,6", "colour": "red"},
+            {"key": "esc", "colour": "#00FF00"},
+            {"row": 1, "col": 3, "color": {"h": 0, "s": 255, "v": 255}},
+        ])) == ([(2, 6, red), (0, 0, green), (1, 3, red)], 0.0)
+        # CSV: row,col,colour or KEY,colour; lines or ';' separated; colours may contain commas
+        assert parse_batch("2,6,red;ESC,#00FF00\n1,3,0,255,255") == \
+            ([(2, 6, red), (0, 0, green), (1, 3, red)], 0.0)
+
         leds_clear()
+        writes = mock.writes
+        assert leds_set_batch("2,6,red;ESC,#00FF00;1,3,rgb(0,0,255)") == 3
+        assert mock.writes == writes + 1, "a batch is one commit"
+        assert mock.matrix[(2, 6)] == red and mock.matrix[(0, 0)] == green
+        assert mock.matrix[(1, 3)] == (0, 0, 255)
+
+        # One bad entry rejects the whole batch: nothing changes, nothing is sent
+        for bad in ("2,6,blue;NOKEY,blue", "2,6,blue;1,3,notacolour", '[{"rc":"2,6","colour":"blue"},{"rc":"1,3"}]'):
+            try:
+                leds_set_batch(bad)
+                assert False, f"Expected ValueError for {bad!r}"
+            except ValueError:
+                pass
+            rpi_mqtt.flush()
+            assert mock.writes == writes + 1 and mock.matrix[(2, 6)] == red
+    finally:
+        rpi_mqtt.KEYMAP.clear()
+        rpi_mqtt.KEYMAP.update(saved)
+
+    print("✓ LED batch tests passed")
+
+def test_write_dedupe():
+    """Test that writes of colours the keyboard already shows are skipped"""
+    print("Testing write deduplication...")
+    import rpi_mqtt
+    from rpi_mqtt import CliBackend, metrics
+
+    mock = mock_backend()
+    leds_set_all("red")
+    writes = mock.writes
+    skipped = metrics.counters.get(("writes_skipped_total", (("backend", "mock"),)), 0)
+
+    # Same colour again (e.g. a retained message): no device write
+    leds_set_all("red")
+    assert mock.writes == writes
+    assert metrics.counters[("writes_skipped_total", (("backend", "mock"),))] == skipped + 1
+
+    # Only the LEDs that differ are written
+    rpi_mqtt.led_set_index(3, "blue")
+    leds_set_all("red")
+    assert mock.writes == writes + 2 and mock.commits[-1] == ([(3, (255, 0, 0))], [])
+
+    # Writes by position and by index reach the same LEDs (LED_INDEX is empty
+    # here, so which LED (1,1) is isn't known): neither may hide the other
+    led_set_rc(1, 1, "blue")
+    writes = mock.writes
+    leds_set_all("red")
+    assert mock.writes == writes + 1 and len(mock.commits[-1][0]) == rpi_mqtt.LED_COUNT
+    led_set_rc(1, 1, "blue")
+    assert mock.writes == writes + 2 and mock.commits[-1] == ([], [(1, 1, (0, 0, 255))])
+    leds_set_all("red")
+    assert mock.writes == writes + 3
+
+    # A reconnect forgets what the keyboard shows and replays everything
+    rpi_mqtt._replay_framebuffer()
+    rpi_mqtt.flush()
+    assert len(mock.commits[-1][0]) == rpi_mqtt.LED_COUNT
+
+    # The CLI backend enters Direct mode once
+    cli = CliBackend()
+    calls = []
+    cli._run = lambda *args: calls.append(args) or SimpleNamespace(returncode=0)
+    cli.commit([(0, (1, 2, 3))], [])
+    cli.commit([(1, (1, 2, 3))], [])
+    assert calls.count(("effect", "Direct")) == 1
+    cli.reset()
+    cli.commit([(2, (1, 2, 3))], [])
+    assert calls.count(("effect", "Direct")) == 2
+
+    # The CLI only takes `led set row,col`: LEDs without a known position are
+    # never sent as a bare index, only as part of a one-colour board
+    assert not rpi_mqtt.LED_INDEX
+    calls.clear()
+    count = rpi_mqtt.LED_COUNT
+    cli.commit([(idx, (255, 0, 0)) for idx in range(count)], [])
+    cli.commit([(idx, (0, 0, 255)) for idx in range(5, count)], [])  # mixed board: skipped
+    cli.commit([(idx, (0, 0, 255)) for idx in range(5)], [])  # one colour again: sent whole
+    cli.commit([(3, (0, 255, 0))], [])  # skipped
+    cli.commit([], [(1, 1, (9, 9, 9))])
+    assert calls == [("leds", "set", "-c", "#ff0000"), ("leds", "set", "-c", "#0000ff"),
+                     ("led", "set", "1,1", "-c", "#090909")]
+
+    print("✓ Write deduplication tests passed")
+
+def test_stream():
+    """Test streamed frames: sequence ordering and a real UDP round trip"""
+    print("Testing streaming input...")
+    import socket
+    import struct
+    import time
+    import rpi_mqtt
+    from rpi_mqtt import StreamReceiver, FRAME_SIZE
+
+    mock = mock_backend()
+
+    def packet(seq, value):
+        return struct.pack("!I", seq) + bytes([value]) * FRAME_SIZE
 
-        print("Testing leds_set_all()...")
+    receiver = StreamReceiver()
+    assert receiver.feed(packet(1, 10), "pc")
+    assert receiver.feed(packet(3, 30), "pc")
+    assert not receiver.feed(packet(2, 20), "pc"), "late packet should be dropped"
+    assert mock.frame == bytes([30]) * FRAME_SIZE
+    assert receiver.feed(packet(0, 40), "other"), "senders are tracked separately"
+    # Sequence numbers wrap around: after 0xFFFFFFFF comes 0
+    assert receiver.feed(packet(0xFFFFFFFF, 50), "wrap")
+    assert receiver.feed(packet(0, 60), "wrap")
+    assert not receiver.feed(packet(0xFFFFFFFE, 0), "wrap")
+    assert not receiver.feed(b"short")
+
+    sock = rpi_mqtt.serve_stream(("127.0.0.1", 0))
+    try:
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto(packet(7, 70), sock.getsockname())
+        deadline = time.monotonic() + 2
+        while mock.frame != bytes([70]) * FRAME_SIZE and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert mock.frame == bytes([70]) * FRAME_SIZE
+        client.close()
+    finally:
+        sock.close()
+
+    print("✓ Streaming input tests passed")
+
+def test_transitions():
+    """Test fades: interpolation on the render loop and cancelling by a new write"""
+    print("Testing transitions...")
+    import rpi_mqtt
+    from rpi_mqtt import fades
+
+    mock = mock_backend()
+    leds_set_all("black")
+
+    assert rpi_mqtt._split_transition('{"colour":"red","transition":2}') == ("red", 2.0)
+    assert rpi_mqtt._split_transition('{"r":255,"g":0,"b":0,"transition":1}') == ('{"r": 255, "g": 0, "b": 0}', 1.0)
+    assert rpi_mqtt._split_transition('{"r":255,"g":0,"b":0}') == ('{"r":255,"g":0,"b":0}', 0.0)
+
+    leds_set_all("#FF0000", transition=1.0)
+    start = fades.fades[0].start
+    assert fades.step(start + 0.5)
+    rpi_mqtt.flush()
+    assert mock.frame[:3] == bytes([127, 0, 0]) and mock.frame[-3:] == bytes([127, 0, 0])
+
+    # A direct write to a fading LED takes it out of the fade
+    rpi_mqtt.led_set_index(0, "blue")
+    fades._next = 0.0
+    fades.step(start + 1.0)
+    rpi_mqtt.flush()
+    assert not fades.active
+    assert mock.frame[:3] == bytes([0, 0, 255]) and mock.frame[-3:] == bytes([255, 0, 0])
+
+    updates, transition = rpi_mqtt.parse_batch('{"transition":0.5,"leds":[{"rc":"2,6","colour":"red"}]}')
+    assert updates == [(2, 6, (255, 0, 0))] and transition == 0.5
+
+    print("✓ Transition tests passed")
+
+def test_presets():
+    """Test saving presets to disk and recalling them by index and name"""
+    print("Testing PresetStore...")
+    import tempfile
+    import rpi_mqtt
+    from rpi_mqtt import PresetStore
+
+    mock = mock_backend()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = PresetStore(os.path.join(tmp, "presets.bin"))
         leds_set_all("red")
+        store.save(1, "alarm")
+        leds_set_all("blue")
+        store.save(2)
+        rpi_mqtt.set_effect("breathe", speed=40, hue=170)
+        store.save(name="calm")
+        rpi_mqtt.effects.stop()
 
-        print("Testing led_set_rc()...")
-        led_set_rc(1, 1, "blue")
+        loaded = PresetStore(store.path)
+        assert loaded.load() == 3
+        assert loaded.get("alarm") is loaded.get(1)
+        assert loaded.get("calm").effect == {"effect": "breathe", "speed": 40, "hue": 170, "saturation": 255}
 
-        print("✓ LED control tests completed (check output above)")
-    except Exception as e:
-        print(f"LED control test error: {e}")
+        loaded.recall("alarm")
+        assert mock.frame == bytes([255, 0, 0]) * rpi_mqtt.LED_COUNT
+        loaded.recall(2)
+        assert mock.frame == bytes([0, 0, 255]) * rpi_mqtt.LED_COUNT
+        loaded.recall("calm")
+        assert rpi_mqtt.effects.name == "breathe" and rpi_mqtt.effects.params.speed == 40
+        rpi_mqtt.effects.stop()
+
+        # Saving under a taken index replaces that preset, name and all
+        loaded.save(1)
+        assert len(loaded) == 3 and "alarm" not in loaded.by_name
+
+        try:
+            loaded.recall(9)
+            assert False, "Expected ValueError"
+        except ValueError:
+            pass
+
+    print("✓ PresetStore tests passed")
+
+def test_keymap():
+    """Test keymap discovery from the library and from `info --ascii` output"""
+    print("Testing keymap discovery...")
+    import json
+    import tempfile
+    import rpi_mqtt
+
+    mock = mock_backend()
+    saved = dict(rpi_mqtt.KEYMAP), dict(rpi_mqtt.LED_INDEX)
+
+    layout = rpi_mqtt.parse_info_ascii("| ESC (0,0) #0 | F1 (0,1) #1 |\n|  A [3,1] led 44  |")
+    assert layout["keys"] == {"ESC": [0, 0], "F1": [0, 1], "A": [3, 1]}
+    assert layout["leds"] == [(0, 0, 0), (0, 1, 1), (3, 1, 44)]
+    # Positions without an LED index could be any text in the drawing
+    assert rpi_mqtt.parse_info_ascii("Model: PI500PLUS, firmware 1,2\n| Z: 4,2 | X (4,3) |") is None
+
+    class Keyboard:
+        model, variant = "PI500PLUS", "ISO"
+        def get_layout(self):
+            return [{"key": "esc", "matrix": (0, 0), "idx": 0}, {"key": "q", "row": 2, "col": 1, "idx": 17}]
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "keymap.json")
+            assert rpi_mqtt.load_keymap(path, Keyboard()) >= 2
+            assert rpi_mqtt.KEY_INDEX["Q"] == 17 and rpi_mqtt.LED_INDEX[(2, 1)] == 17
+            with open(path) as f:
+                assert json.load(f)["model"] == "PI500PLUS"
+
+            # Per-key topics write the framebuffer by index
+            rpi_mqtt.on_message(None, None, SimpleNamespace(
+                topic=f"{rpi_mqtt.BASE}/led/key/Q", payload=b"#00FF00"))
+            assert mock.frame[17 * 3:17 * 3 + 3] == bytes([0, 255, 0])
+
+        # A layout without LED indexes is logged, not applied or cached
+        class NoIndexes(Keyboard):
+            def get_layout(self):
+                return [{"key": "x", "row": 4, "col": 3}]
+        rpi_mqtt.KEYMAP.clear()
+        info_ascii = rpi_mqtt.info_ascii
+        rpi_mqtt.info_ascii = lambda: "| Z: 4,2 | X (4,3) |"
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "keymap.json")
+                assert rpi_mqtt.discover_layout(NoIndexes()) is None
+                assert rpi_mqtt.load_keymap(path, NoIndexes()) == 0 and not os.path.exists(path)
+        finally:
+            rpi_mqtt.info_ascii = info_ascii
+    finally:
+        for table, old in zip((rpi_mqtt.KEYMAP, rpi_mqtt.LED_INDEX), saved):
+            table.clear()
+            table.update(old)
+        rpi_mqtt.KEY_INDEX.clear()
+
+    print("✓ Keymap tests passed")
+
+def test_layers():
+    """Test layers composited over the base frame by z, opacity and mask"""
+    print("Testing layers...")
+    import rpi_mqtt
+    from rpi_mqtt import BASE, LED_COUNT, layers
+
+    mock = mock_backend()
+
+    def publish(topic, payload):
+        rpi_mqtt.on_message(None, None, SimpleNamespace(topic=f"{BASE}/{topic}", payload=payload))
+
+    def led(idx):
+        return tuple(mock.frame[idx * 3:idx * 3 + 3])
+
+    try:
+        leds_set_all("red")
+        layers.paint("keys", [5], bytes([0, 0, 255]))
+        assert led(5) == (0, 0, 255) and led(4) == (255, 0, 0)
+
+        # A new background keeps the highlight
+        leds_set_all("green")
+        assert led(5) == (0, 0, 255) and led(4) == (0, 255, 0)
+
+        # An alert above it, half transparent over the whole board
+        publish("layer/alert/led", b"white")
+        publish("layer/alert/z", b"10")
+        publish("layer/alert/opacity", b"128")
+        assert led(4) == (128, 255, 128) and led(5) == (128, 128, 255)
+
+        # Masked to LED 4 only
+        publish("layer/alert/mask", bytes([255 if i == 4 else 0 for i in range(LED_COUNT)]))
+        assert led(4) == (128, 255, 128) and led(5) == (0, 0, 255) and led(6) == (0, 255, 0)
+
+        publish("layer/alert/delete", b"")
+        publish("layer/keys/clear", b"")
+        assert led(4) == (0, 255, 0) and led(5) == (0, 255, 0)
+        assert list(layers.layers) == ["keys"]
+    finally:
+        for name in list(layers.layers):
+            layers.remove(name)
+
+    print("✓ Layer tests passed")
+
+def test_system_metrics():
+    """Test the /proc sources (deltas between reads) and the meter effects"""
+    print("Testing system metrics...")
+    import tempfile
+    from rpi_mqtt import (CpuLoad, MemoryUse, NetworkLoad, Geometry, EffectParams,
+                          led_positions, _bars, _effect_cpu_heatmap, _METER_DIM)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def write(name, text):
+            with open(os.path.join(tmp, name), "w") as f:
+                f.write(text)
+
+        # The file stays open between reads; each read sees the new contents
+        write("stat", "cpu  100 0 100 800 0 0 0 0 0 0\ncpu0 50 0 50 400 0 0 0 0\ncpu1 50 0 50 400 0 0 0 0\nintr 1\n")
+        cpu = CpuLoad(os.path.join(tmp, "stat"))
+        assert cpu.read() == (0.0, [0.0, 0.0])
+        handle = cpu.file._file
+        write("stat", "cpu  200 0 150 850 0 0 0 0 0 0\ncpu0 150 0 50 400 0 0 0 0\ncpu1 50 0 100 450 0 0 0 0\nintr 1\n")
+        assert cpu.read() == (0.75, [1.0, 0.5]) and cpu.file._file is handle
+
+        write("meminfo", "MemTotal: 1000 kB\nMemFree: 100 kB\nMemAvailable: 250 kB\n")
+        assert MemoryUse(os.path.join(tmp, "meminfo")).read() == 0.75
+
+        header = "Inter-|   Receive\n face |bytes packets\n"
+        def dev(rx, tx):
+            return (header + f"    lo: 999999 1 0 0 0 0 0 0 999999 1 0 0 0 0 0 0\n"
+                    f"  eth0: {rx} 1 0 0 0 0 0 0 {tx} 1 0 0 0 0 0 0\n")
+        write("dev", dev(0, 0))
+        net = NetworkLoad(os.path.join(tmp, "dev"), scale=1000)
+        assert net.read(now=10.0) == (0.0, 0.0)
+        write("dev", dev(1000, 250))
+        assert net.read(now=12.0) == (0.5, 0.125)  # loopback ignored
+        write("dev", dev(0, 0))  # counters reset
+        assert net.read(now=13.0) == (0.0, 0.0)
+
+        # Missing file (not Linux): no load, no exception
+        assert MemoryUse(os.path.join(tmp, "missing")).read() == 0.0
+        cpu.file.close()
+        net.file.close()
+
+    g = Geometry(led_positions())
+    _, value = _bars(g, [0.5, 1.0])
+    lit = [v == 255 for v in value]
+    assert all(lit[i] == (g.x[i] < 128) for i in range(len(lit)) if g.y[i] < 128)
+    assert all(lit[i] for i in range(len(lit)) if g.y[i] >= 128)
+    assert _bars(g, [0.0])[1] == bytes([_METER_DIM]) * len(g.x)
+
+    hue, value = _effect_cpu_heatmap(0.0, EffectParams(), g)
+    assert len(hue) == len(g.x) and value == 255
+
+    print("✓ System metrics tests passed")
+
+def test_notifications():
+    """Test notify overlays: priority per LED, expiry from the heap, cancel"""
+    print("Testing notifications...")
+    import time
+    import rpi_mqtt
+    from rpi_mqtt import Notifier, LED_COUNT, layers
+
+    mock = mock_backend()
+    leds_set_all("green")
+
+    def led(idx):
+        return tuple(mock.frame[idx * 3:idx * 3 + 3])
+
+    args = rpi_mqtt.parse_notification('{"colour":"red","leds":[1,2],"priority":3,"ttl":5,"id":"build"}')
+    assert args == {"leds": [1, 2], "rgb": (255, 0, 0), "priority": 3, "ttl": 5.0,
+                    "pattern": "solid", "id": "build"}
+    assert rpi_mqtt.parse_notification("blue")["leds"] == list(range(LED_COUNT))
+
+    notifier = Notifier()
+    try:
+        now = time.monotonic()
+        notifier.notify(**args)
+        notifier.notify(list(range(LED_COUNT)), (0, 0, 255), priority=1, ttl=1, id="doorbell")
+        assert led(1) == (255, 0, 0) and led(3) == (0, 0, 255)
+
+        # The doorbell expires; the underlying colour comes back by itself
+        assert 0 < notifier.next_due(now) < 1.1
+        notifier.step(now + 1.5)
+        rpi_mqtt.flush()
+        assert led(1) == (255, 0, 0) and led(3) == (0, 255, 0) and len(notifier) == 1
+
+        # Replacing by id leaves a stale heap entry that must not expire it early
+        notifier.notify([1], (255, 255, 0), ttl=10, id="build")
+        notifier.step(now + 6)
+        assert len(notifier) == 1
+        notifier.cancel("build")
+        rpi_mqtt.flush()
+        assert led(1) == (0, 255, 0) and notifier.LAYER not in layers.layers
+
+        # Hundreds pending: only due ones are touched
+        for i in range(300):
+            notifier.notify([i % LED_COUNT], (i % 256, 0, 0), priority=i % 7, ttl=1 + i / 100)
+        notifier.step(now + 2.0)
+        assert 0 < len(notifier) < 300
+    finally:
+        layers.remove(notifier.LAYER)
+
+    print("✓ Notification tests passed")
+
+def test_clips():
+    """Test clip upload (memory and mmap), timed playback, loop and delete"""
+    print("Testing clips...")
+    import tempfile
+    import time
+    import zlib
+    import rpi_mqtt
+    from rpi_mqtt import ClipStore, FRAME_SIZE, player
+
+    mock = mock_backend()
+    frames = bytes([10]) * FRAME_SIZE + bytes([20]) * FRAME_SIZE + bytes([30]) * FRAME_SIZE
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ClipStore(tmp, mmap_bytes=2 * FRAME_SIZE)
+        small = store.add("small", b'{"fps": 10}\n' + frames[:FRAME_SIZE])
+        assert small.path is None and small.count == 1
+        big = store.add("big", b'{"durations": [100, 200, 100], "encoding": "zlib"}\n' + zlib.compress(frames))
+        assert big.path and big.count == 3 and abs(big.duration - 0.4) < 1e-9
+
+        # Frames follow the clip's own timing from the start time
+        player.play(big)
+        start = player._state[2]
+        assert mock.frame == bytes([10]) * FRAME_SIZE
+        for t, value in ((0.15, 20), (0.29, 20), (0.31, 30)):
+            player.step(start + t)
+            rpi_mqtt.flush()
+            assert mock.frame == bytes([value]) * FRAME_SIZE, t
+        player.step(start + 0.5)
+        assert player.clip is None, "once-through playback ends"
+
+        player.play(big, loop=True)
+        start = player._state[2]
+        player._next = 0.0
+        player.step(start + 0.45)  # second time round, first frame
+        rpi_mqtt.flush()
+        assert mock.frame == bytes([10]) * FRAME_SIZE and player.clip is big
+
+        # Any other write stops the clip
+        leds_set_all("red")
+        assert player.clip is None
+
+        # ... including batches, fades and row/col writes to LEDs without an index
+        for write in (lambda: rpi_mqtt.leds_set_batch("0,0,red"),
+                      lambda: leds_set_all("blue", transition=1),
+                      lambda: rpi_mqtt.led_set_index(5, "blue", transition=1),
+                      lambda: rpi_mqtt.led_set_rc(9, 9, "red")):
+            player.play(big, loop=True)
+            write()
+            assert player.clip is None
+        rpi_mqtt.fades.cancel()
+        player.play(big, loop=True)
+        rpi_mqtt.leds_set_batch("0,0,red")
+        player.step(time.monotonic() + 0.15)
+        rpi_mqtt.flush()
+        assert mock.matrix[(0, 0)] == (255, 0, 0), "clip frame overwrote the batch"
+
+        # Mapped clips come back after a restart; delete removes the file
+        reloaded = ClipStore(tmp)
+        assert reloaded.load() == 1 and reloaded.get("big").count == 3
+        reloaded.get("big").close()
+        store.remove("big")
+        assert ClipStore(tmp).load() == 0
+
+        for bad in (frames, b'{"fps": 10}\n' + frames[:10], b'{"durations": [1]}\n' + frames):
+            try:
+                store.add("bad", bad)
+                assert False, "Expected ValueError"
+            except ValueError:
+                pass
+
+    print("✓ Clip tests passed")
+
+def test_renderer():
+    """Test the render thread: FPS cap, folded requests, handlers run on the thread"""
+    print("Testing Renderer...")
+    import time
+    import rpi_mqtt
+
+    mock = mock_backend()
+    rpi_mqtt.flush()
+
+    def publish(topic, payload):
+        rpi_mqtt.on_message(None, None, SimpleNamespace(topic=f"{rpi_mqtt.BASE}/{topic}", payload=payload))
+
+    rpi_mqtt.renderer = rpi_mqtt.Renderer(fps=20)
+    rpi_mqtt.renderer.start()
+    try:
+        # A flood folds into a few frames; only the last colour reaches the keyboard
+        writes = mock.writes
+        start = time.monotonic()
+        for v in range(200):
+            publish("led", f"#00{v:02X}00".encode())
+        time.sleep(0.3)
+        assert mock.frame == bytes([0, 199, 0]) * rpi_mqtt.LED_COUNT
+        elapsed = time.monotonic() - start
+        assert 1 <= mock.writes - writes <= elapsed * 20 + 2, mock.writes - writes
+
+        # Queued handlers run on the render thread, where request_flush() leaves
+        # the write to the end of the tick: many LEDs, one commit per tick
+        writes = mock.writes
+        for col in range(15):
+            publish(f"led/5,{col}", b"#0000FF")
+        time.sleep(0.2)
+        assert all(mock.matrix[(5, col)] == (0, 0, 255) for col in range(15))
+        assert mock.writes - writes <= 2, mock.writes - writes
+    finally:
+        rpi_mqtt.renderer.stop()
+        rpi_mqtt.renderer.join(1)
+        rpi_mqtt.renderer = None
+
+    print("✓ Renderer tests passed")
+
+def test_async_renderer():
+    """Test the asyncio render loop: queued messages, effects clock, stop"""
+    print("Testing AsyncRenderer...")
+    import asyncio
+    import rpi_mqtt
+
+    mock = mock_backend()
+
+    async def run():
+        rpi_mqtt.renderer = rpi_mqtt.AsyncRenderer(fps=100)
+        rpi_mqtt.renderer.start()
+        try:
+            for v in range(50):
+                rpi_mqtt.on_message(None, None, SimpleNamespace(
+                    topic=f"{rpi_mqtt.BASE}/led", payload=f"#0000{v:02X}".encode()))
+            await asyncio.sleep(0.1)
+            assert mock.frame == bytes([0, 0, 49]) * rpi_mqtt.LED_COUNT
+            assert len(rpi_mqtt.inbox) == 0
+
+            rpi_mqtt.set_effect("cycle", speed=255)
+            frames = rpi_mqtt.renderer.frames
+            await asyncio.sleep(0.2)
+            assert rpi_mqtt.renderer.frames > frames + 2, "effect clock should keep drawing"
+        finally:
+            rpi_mqtt.effects.stop()
+            await rpi_mqtt.renderer.stop()
+            rpi_mqtt.renderer = None
+
+    asyncio.run(run())
+    print("✓ AsyncRenderer tests passed")
 
 def main():
     """Run all tests"""
@@ -57,7 +954,27 @@ def main():
 
     try:
         test_color_parsing()
+        test_parse_colour_rgb()
+        test_postprocess()
+        test_effects()
+        test_device_reconnect()
+        test_log_rate_limit()
+        test_metrics()
+        test_inbox()
         test_led_functions()
+        test_frames()
+        test_led_batch()
+        test_write_dedupe()
+        test_stream()
+        test_transitions()
+        test_presets()
+        test_keymap()
+        test_layers()
+        test_system_metrics()
+        test_notifications()
+        test_clips()
+        test_renderer()
+        test_async_renderer()
         print("\n=== All tests completed successfully! ===")
     except Exception as e:
         print(f"\nTest failed: {e}")